@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Replay an arr-retry trace through the real controllers in virtual time.
+
+Record a trace by running arr-retry with TRACE_FILE set, then compare
+parameter sets offline; every combination runs against a fresh copy of
+arr-retry:
+
+    python3 scripts/arr-retry-sim.py trace.jsonl \\
+        --param MISSING_MAX_BATCH=4,6,8 --param SONARR_MISSING_WEIGHT=1,2
+
+Arr history and wanted-missing pages are served from the trace as they were
+at each virtual moment, so the failure handlers see the recorded failures.
+SABnzbd is modelled instead of replayed, because its queue depends on the
+searches being simulated: it downloads at the recorded line speed, and each
+item searched lands a grab SAB_GRAB_LEAD_TIME later with probability
+--hit-rate, sized and failing like the recorded SAB history. Weights of
+ARR_INSTANCES entries are tuned as <NAME>_MISSING_WEIGHT.
+
+Reported per set: time the SAB queue sat empty, searches issued and the
+estimated indexer hits they cost.
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import functools
+import gzip
+import heapq
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import types
+from datetime import datetime, timezone
+from urllib import parse
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+
+
+def load_script(module_name, filename):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPTS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Trace:
+    """Responses per URL, sorted by time, plus the recorded instance list."""
+
+    def __init__(self, path):
+        self.instances = []
+        self.responses = {}
+        with open(path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        opener = gzip.open if compressed else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A crash can leave the last line cut short.
+                        continue
+                    if "instances" in entry:
+                        self.instances = entry["instances"]
+                    else:
+                        self.responses.setdefault(entry["u"], []).append((entry["t"], entry["b"]))
+            except EOFError:
+                # A gzip trace that was never closed; keep what was read.
+                print(f"{path}: truncated gzip stream, replaying what was read")
+
+        if not self.responses:
+            raise SystemExit(f"{path}: no recorded responses")
+        for series in self.responses.values():
+            series.sort(key=lambda response: response[0])
+        self.start = min(series[0][0] for series in self.responses.values())
+        self.end = max(series[-1][0] for series in self.responses.values())
+
+    def lookup(self, url, now):
+        """The latest response at or before `now`, else the first one after it."""
+        series = self.responses.get(url)
+        if not series:
+            return None
+        position = bisect.bisect_right(series, now, key=lambda response: response[0])
+        return series[max(0, position - 1)][1]
+
+    def sab_series(self, mode):
+        for url, series in self.responses.items():
+            if dict(parse.parse_qsl(parse.urlsplit(url).query)).get("mode") == mode:
+                for t, body in series:
+                    yield t, json.loads(body).get(mode) or {}
+
+
+class VirtualClock:
+    """Stands in for the time module inside the simulated arr-retry."""
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def virtual_datetime(clock):
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.now, tz)
+
+    return VirtualDatetime
+
+
+class SabModel:
+    """
+    A SAB queue fed by the simulated searches and drained at the recorded
+    line speed (or --line-speed while production was idle).
+    """
+
+    def __init__(self, trace, clock, rng, args, arr):
+        self.clock = clock
+        self.rng = rng
+        self.hit_rate = args.hit_rate
+        self.lead_time = arr.SAB_GRAB_LEAD_TIME
+        self.history_sample = arr.SAB_HISTORY_SAMPLE
+
+        # (time, MB/s or 0, paused) from every recorded queue poll.
+        self.speeds = [
+            (t, arr.parse_float(queue.get("kbpersec")) / 1024,
+             bool(queue.get("paused")) or str(queue.get("status", "")).lower() == "paused")
+            for t, queue in trace.sab_series("queue")
+        ]
+        observed = [speed for _, speed, _ in self.speeds if speed > 0]
+        self.line_speed = args.line_speed or (statistics.median(observed) if observed else 10.0)
+
+        jobs = {}
+        for _, history in trace.sab_series("history"):
+            for slot in history.get("slots") or []:
+                status = str(slot.get("status", "")).lower()
+                if status in ("completed", "failed"):
+                    jobs[(slot.get("completed"), slot.get("bytes"))] = (
+                        arr.parse_float(slot.get("bytes")) / MB, status == "completed"
+                    )
+        sizes = [mb for mb, ok in jobs.values() if ok and mb > 0]
+        self.grab_mb = statistics.mean(sizes) if sizes else float(arr.SAB_ESTIMATED_MB_PER_GRAB)
+        self.success_rate = sum(ok for _, ok in jobs.values()) / len(jobs) if jobs else 1.0
+
+        self.queue = []
+        self.arrivals = []
+        self.history = []
+        self.updated = clock.now
+        self.idle_seconds = 0.0
+        self.paused_seconds = 0.0
+        self.downloaded_mb = 0.0
+        self.grabs = 0
+
+    def _conditions(self, t):
+        position = bisect.bisect_right(self.speeds, t, key=lambda sample: sample[0])
+        if not position:
+            return self.line_speed, False
+        _, speed, paused = self.speeds[position - 1]
+        return speed or self.line_speed, paused
+
+    def _drain(self, seconds):
+        rate, paused = self._conditions(self.updated)
+        if paused:
+            self.paused_seconds += seconds
+            return
+        elapsed = 0.0
+        while self.queue and elapsed < seconds:
+            job = self.queue[0]
+            needed = job["mb"] / rate
+            if needed > seconds - elapsed:
+                job["mb"] -= rate * (seconds - elapsed)
+                self.downloaded_mb += rate * (seconds - elapsed)
+                return
+            elapsed += needed
+            self.downloaded_mb += job["mb"]
+            self.queue.pop(0)
+            self.history.append({
+                "completed": int(self.updated + elapsed),
+                "bytes": int(job["size"] * MB),
+                "status": "Completed" if job["ok"] else "Failed",
+            })
+        self.idle_seconds += seconds - elapsed
+
+    def advance(self):
+        now = self.clock.now
+        while self.updated < now:
+            step_end = now
+            if self.arrivals:
+                step_end = min(step_end, max(self.updated, self.arrivals[0][0]))
+            self._drain(step_end - self.updated)
+            self.updated = step_end
+            while self.arrivals and self.arrivals[0][0] <= self.updated:
+                _, _, job = heapq.heappop(self.arrivals)
+                self.queue.append(job)
+        self.history = self.history[-self.history_sample:]
+
+    def search(self, items):
+        """Each searched item turns into a grab with probability hit_rate."""
+        for _ in range(items):
+            if self.rng.random() < self.hit_rate:
+                self.grabs += 1
+                size = self.grab_mb * self.rng.uniform(0.5, 1.5)
+                job = {"mb": size, "size": size, "ok": self.rng.random() < self.success_rate}
+                heapq.heappush(self.arrivals, (self.clock.now + self.lead_time, self.grabs, job))
+
+    def queue_response(self):
+        self.advance()
+        rate, paused = self._conditions(self.clock.now)
+        mbleft = sum(job["mb"] for job in self.queue)
+        seconds = int(mbleft / rate) if self.queue else 0
+        return {"queue": {
+            "slots": [{} for _ in self.queue],
+            "mbleft": f"{mbleft:.2f}",
+            "kbpersec": f"{rate * 1024:.2f}" if self.queue and not paused else "0",
+            "timeleft": f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}",
+            "paused": paused,
+        }}
+
+    def history_response(self):
+        self.advance()
+        return {"history": {"slots": list(reversed(self.history))}}
+
+
+class ReplayClient:
+    """Answers arr-retry's HTTP calls from the trace and the SAB model."""
+
+    def __init__(self, trace, sab):
+        self.trace = trace
+        self.sab = sab
+        self.commands = 0
+        self.misses = 0
+
+    def request(self, method, url, label, headers=None, body=None):
+        if label == "/command":
+            if method == "GET":
+                return b"[]"
+            payload = json.loads(body)
+            ids = next((value for key, value in payload.items() if key.endswith("Ids")), None)
+            # Season and series searches are counted as one grab chance.
+            self.sab.search(len(ids) if ids is not None else 1)
+            self.commands += 1
+            return b"{}"
+        if label == "sab:queue":
+            return json.dumps(self.sab.queue_response()).encode()
+        if label == "sab:history":
+            return json.dumps(self.sab.history_response()).encode()
+
+        response = self.trace.lookup(url, self.sab.clock.now)
+        if response is None:
+            self.misses += 1
+            return b'{"records": []}'
+        return response.encode()
+
+    def take_stats(self):
+        return {}
+
+
+def instances_spec(trace, overrides):
+    entries = []
+    for instance in trace.instances:
+        weight = overrides.get(f"{instance['name'].upper()}_MISSING_WEIGHT", instance["weight"])
+        entries.append(f"{instance['name']}={instance['kind']},{instance['url']},sim,{weight}")
+    return ";".join(entries)
+
+
+async def run_inline(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+async def simulate(trace, overrides, args):
+    env = dict(overrides, METRICS_PORT="0", SAB_API_KEY="sim", WEBHOOKS_ENABLED="false", TRACE_FILE="")
+    if trace.instances:
+        env["ARR_INSTANCES"] = instances_spec(trace, overrides)
+    saved = dict(os.environ)
+    os.environ.update(env)
+    try:
+        arr = load_script("arr_retry_sim", "arr-retry.py")
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+    clock = VirtualClock(trace.start)
+    arr.time = clock
+    # Replayed calls never block, so skip the worker-thread hop.
+    arr.asyncio = types.SimpleNamespace(**vars(asyncio))
+    arr.asyncio.to_thread = run_inline
+    arr.datetime = virtual_datetime(clock)
+    random.seed(args.seed)
+
+    state_dir = tempfile.mkdtemp(prefix="arr-sim-")
+    arr.STATE_DIR = state_dir
+    arr.STATE_FILE = os.path.join(state_dir, "state.json")
+    arr.STATE_DB = os.path.join(state_dir, "state.db")
+    state = arr.load_state()
+
+    sab = SabModel(trace, clock, random.Random(args.seed), args, arr)
+    client = ReplayClient(trace, sab)
+    arr.HTTP = client
+
+    # Count what the limiter actually grants: that is what reaches indexers.
+    limiter = arr.SEARCH_LIMITER = arr.TokenBucket(arr.SEARCH_RATE_PER_HOUR, arr.SEARCH_BURST)
+    indexer_hits = 0
+    take = limiter.take
+
+    def counting_take(cost, partial=False):
+        nonlocal indexer_hits
+        granted = take(cost, partial)
+        indexer_hits += granted
+        return granted
+
+    limiter.take = counting_take
+
+    tasks = [arr.ScheduledTask("Backfill", arr.handle_missing_backfill, arr.MISSING_MIN_INTERVAL)]
+    for instance in arr.ARR_INSTANCES.values():
+        if instance.api_key:
+            handler = functools.partial(arr.handle_arr_failures, instance)
+            tasks.append(arr.ScheduledTask(instance.name, handler, arr.FAILURE_CHECK_INTERVAL))
+    scheduler = arr.TaskScheduler(tasks)
+
+    end = trace.end if args.days is None else min(trace.end, trace.start + args.days * 86400)
+    cycles = 0
+    while clock.now + scheduler.seconds_until_next() <= end:
+        clock.now += scheduler.seconds_until_next()
+        due = scheduler.pop_due()
+        if not due:
+            continue
+        await arr.run_due_tasks(scheduler, due, state, {})
+        state.commit()
+        cycles += 1
+    clock.now = end
+    sab.advance()
+
+    span = max(1.0, end - trace.start)
+    return {
+        "params": overrides,
+        "virtual_hours": round(span / 3600, 1),
+        "cycles": cycles,
+        "queue_idle_hours": round(sab.idle_seconds / 3600, 2),
+        "queue_idle_pct": round(100 * sab.idle_seconds / span, 1),
+        "paused_hours": round(sab.paused_seconds / 3600, 2),
+        "retry_searches": arr.METRICS.total("arr_retry_searches_triggered_total", kind="retry"),
+        "backfill_searches": arr.METRICS.total("arr_retry_searches_triggered_total", kind="backfill"),
+        "commands": client.commands,
+        "indexer_hits": indexer_hits,
+        "grabs": sab.grabs,
+        "downloaded_gb": round(sab.downloaded_mb / 1024, 1),
+        "trace_misses": client.misses,
+    }
+
+
+def parse_params(values):
+    """["A=1,2", "B=x"] -> [{"A": "1", "B": "x"}, {"A": "2", "B": "x"}]"""
+    axes = []
+    for value in values:
+        name, sep, options = value.partition("=")
+        if not sep or not name:
+            raise SystemExit(f"--param expects NAME=value[,value...], got {value!r}")
+        axes.append([(name.strip(), option.strip()) for option in options.split(",")])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def print_report(trace, results):
+    print(f"trace: {len(trace.responses)} URLs, "
+          f"{datetime.fromtimestamp(trace.start, timezone.utc):%Y-%m-%d %H:%M} to "
+          f"{datetime.fromtimestamp(trace.end, timezone.utc):%Y-%m-%d %H:%M} UTC")
+    print(f"{'idle h':>8} {'idle %':>7} {'retry':>6} {'backfill':>8} {'hits':>6} {'grabs':>6} {'GB':>8}  params")
+    for row in results:
+        params = " ".join(f"{name}={value}" for name, value in row["params"].items()) or "(defaults)"
+        print(f"{row['queue_idle_hours']:>8.2f} {row['queue_idle_pct']:>7.1f} {row['retry_searches']:>6} "
+              f"{row['backfill_searches']:>8} {row['indexer_hits']:>6} {row['grabs']:>6} "
+              f"{row['downloaded_gb']:>8.1f}  {params}")
+    misses = max(row["trace_misses"] for row in results)
+    if misses:
+        print(f"\n{misses} request(s) had no recorded response and were answered empty; "
+              "settings that change page sizes replay less faithfully.")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", help="trace file written by arr-retry with TRACE_FILE set")
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=V1[,V2...]",
+                        help="arr-retry setting to sweep; repeat for a grid")
+    parser.add_argument("--days", type=float, help="only replay this many days from the start")
+    parser.add_argument("--hit-rate", type=float, default=0.3,
+                        help="chance that a searched item results in a grab")
+    parser.add_argument("--line-speed", type=float,
+                        help="SAB speed in MB/s while production was idle (default: recorded median)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for jitter and grab outcomes")
+    parser.add_argument("--verbose", action="store_true", help="show arr-retry's own log output")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    trace = Trace(args.trace)
+
+    results = []
+    # arr-retry logs every action; keep that out of the report unless asked.
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        for overrides in parse_params(args.param):
+            results.append(asyncio.run(simulate(trace, overrides, args)))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(trace, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,140 @@
 #!/usr/bin/env python3
+import asyncio
+import contextlib
+import functools
+import gzip
+import heapq
+import http.client
+import itertools
 import json
 import math
 import os
+import random
+import re
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from urllib import parse, request
+from urllib import parse
 
 # -------------------------------------------------------------------
 # CONFIG
 # -------------------------------------------------------------------
 STATE_DIR = "/state"
 STATE_FILE = os.path.join(STATE_DIR, "state.json")
+STATE_DB = os.path.join(STATE_DIR, "state.db")
 
 SONARR_URL = os.environ.get("SONARR_URL", "http://sonarr:8989")
 RADARR_URL = os.environ.get("RADARR_URL", "http://radarr:7878")
+LIDARR_URL = os.environ.get("LIDARR_URL", "http://lidarr:8686")
 SAB_URL = os.environ.get("SAB_URL", "http://sabnzbd:8081")
 SONARR_API_KEY = os.environ.get("SONARR_API_KEY", "")
 RADARR_API_KEY = os.environ.get("RADARR_API_KEY", "")
+LIDARR_API_KEY = os.environ.get("LIDARR_API_KEY", "")
+# Any number of arr instances as "Name=type,url,api_key[,weight]" entries
+# separated by ";", e.g. "Sonarr4K=sonarr,http://sonarr4k:8989,abc,1".
+# When unset, the SONARR_*/RADARR_*/LIDARR_* settings above are used.
+ARR_INSTANCES_SPEC = os.environ.get("ARR_INSTANCES", "").strip()
 SAB_API_KEY = os.environ.get("SAB_API_KEY", "").strip()
 SAB_API_KEY_FILE = os.environ.get("SAB_API_KEY_FILE", "/sabnzbd.ini")
 LOOP_INTERVAL = int(os.environ.get("LOOP_INTERVAL", "120"))
+FAILURE_CHECK_INTERVAL = int(os.environ.get("FAILURE_CHECK_INTERVAL", str(LOOP_INTERVAL)))
+# With webhooks enabled, failures arrive as they happen and the history poll
+# only runs every RECONCILE_INTERVAL as a safety net for missed deliveries.
+# The /webhook/* routes answer 404 unless enabled; set WEBHOOK_TOKEN along
+# with it, or anything that can reach port 9797 can trigger searches.
+WEBHOOKS_ENABLED = os.environ.get("WEBHOOKS_ENABLED", "").strip().lower() in ("1", "true", "yes")
+WEBHOOK_TOKEN = os.environ.get("WEBHOOK_TOKEN", "").strip()
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", "900"))
+# After a SABnzbd failure notification, reconcile arr history this many seconds
+# later, once the arr has had a chance to record the failure itself.
+SAB_NOTIFY_RECHECK_DELAY = int(os.environ.get("SAB_NOTIFY_RECHECK_DELAY", "75"))
+# Each task's next run is spread by +/- this fraction of its interval.
+TASK_JITTER = float(os.environ.get("TASK_JITTER", "0.1"))
+TASK_MAX_BACKOFF = int(os.environ.get("TASK_MAX_BACKOFF", "1800"))
 LOOKBACK_HOURS = int(os.environ.get("LOOKBACK_HOURS", "24"))
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "200"))
+HISTORY_MAX_PAGES = int(os.environ.get("HISTORY_MAX_PAGES", "25"))
+# Optional server-side eventType filter for /history (e.g. "4" = downloadFailed
+# on both Sonarr and Radarr). Left empty by default because the secondary
+# failure signals in is_sonarr_failure/is_radarr_failure can appear on other
+# event types.
+HISTORY_EVENT_TYPE = os.environ.get("HISTORY_EVENT_TYPE", "").strip()
+# Episodes queued in one cycle are promoted to a SeasonSearch once this many
+# share a season, and to a SeriesSearch once this many seasons of one series
+# were promoted. 0 disables the promotion.
+SEARCH_SEASON_PROMOTE_MIN = int(os.environ.get("SEARCH_SEASON_PROMOTE_MIN", "3"))
+SEARCH_SERIES_PROMOTE_MIN_SEASONS = int(os.environ.get("SEARCH_SERIES_PROMOTE_MIN_SEASONS", "2"))
+# Global indexer budget shared by every search path, in estimated indexer
+# queries per hour, plus how many can be spent at once.
+SEARCH_RATE_PER_HOUR = float(os.environ.get("SEARCH_RATE_PER_HOUR", "120"))
+SEARCH_BURST = int(os.environ.get("SEARCH_BURST", "20"))
+# Hold off new searches while an arr already has this many queued/running.
+COMMAND_QUEUE_MAX = int(os.environ.get("COMMAND_QUEUE_MAX", "3"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_COOLDOWN = int(os.environ.get("CIRCUIT_COOLDOWN", "300"))
+# Failure retries are tracked per episode/movie/album: failures dated before
+# the last retry ride on it, later ones wait out a cooldown of
+# RETRY_BACKOFF_BASE doubling per retry (up to RETRY_BACKOFF_MAX), and after
+# RETRY_MAX_ATTEMPTS retries the item is flagged instead.
+RETRY_BACKOFF_BASE = int(os.environ.get("RETRY_BACKOFF_BASE", "1800"))
+RETRY_BACKOFF_MAX = int(os.environ.get("RETRY_BACKOFF_MAX", "86400"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "6"))
 MISSING_MIN_INTERVAL = int(os.environ.get("MISSING_MIN_INTERVAL", "120"))
 MISSING_IDLE_RECHECK_INTERVAL = int(os.environ.get("MISSING_IDLE_RECHECK_INTERVAL", "300"))
 MISSING_MAX_BATCH = int(os.environ.get("MISSING_MAX_BATCH", "6"))
 MISSING_DEFAULT_BATCH = int(os.environ.get("MISSING_DEFAULT_BATCH", "2"))
+MISSING_INDEX_TTL = int(os.environ.get("MISSING_INDEX_TTL", "3600"))
+MISSING_PAGE_SIZE = int(os.environ.get("MISSING_PAGE_SIZE", "200"))
+# Backfill picks the best-scoring items out of a window this many times larger
+# than its budget.
+MISSING_PRIORITY_WINDOW = int(os.environ.get("MISSING_PRIORITY_WINDOW", "10"))
+MISSING_RECENCY_HALF_LIFE_DAYS = float(os.environ.get("MISSING_RECENCY_HALF_LIFE_DAYS", "30"))
+MISSING_ITEM_BACKOFF_BASE = int(os.environ.get("MISSING_ITEM_BACKOFF_BASE", "21600"))
+MISSING_ITEM_BACKOFF_MAX = int(os.environ.get("MISSING_ITEM_BACKOFF_MAX", "2592000"))
 SAB_MIN_QUEUE_ITEMS = int(os.environ.get("SAB_MIN_QUEUE_ITEMS", "8"))
 SAB_MIN_QUEUE_MB = int(os.environ.get("SAB_MIN_QUEUE_MB", "30000"))
 SAB_ESTIMATED_MB_PER_GRAB = int(os.environ.get("SAB_ESTIMATED_MB_PER_GRAB", "8000"))
+SAB_HISTORY_SAMPLE = int(os.environ.get("SAB_HISTORY_SAMPLE", "50"))
+# Seconds between queueing a search and its NZB actually downloading; the queue
+# must hold at least this much work beyond the next backfill check.
+SAB_GRAB_LEAD_TIME = int(os.environ.get("SAB_GRAB_LEAD_TIME", "900"))
+SAB_STATS_SMOOTHING = float(os.environ.get("SAB_STATS_SMOOTHING", "0.2"))
+# Watch SAB directly for failed jobs, slots that stop making progress and
+# repairs that drag on, and replace them through the arr queue (remove from
+# SAB, blocklist, search again) without waiting for arr /history.
+SAB_MONITOR_ENABLED = os.environ.get("SAB_MONITOR_ENABLED", "").strip().lower() in ("1", "true", "yes")
+SAB_MONITOR_INTERVAL = int(os.environ.get("SAB_MONITOR_INTERVAL", "60"))
+SAB_STALL_TIMEOUT = int(os.environ.get("SAB_STALL_TIMEOUT", "1800"))
+SAB_REPAIR_TIMEOUT = int(os.environ.get("SAB_REPAIR_TIMEOUT", "5400"))
+ARR_QUEUE_PAGE_SIZE = int(os.environ.get("ARR_QUEUE_PAGE_SIZE", "500"))
+# qBittorrent Web UI; when set, downloading torrents count towards the
+# backfill queue. With QBIT_MONITOR_ENABLED, torrents stalled, stuck fetching
+# metadata or without seeds for QBIT_STALL_TIMEOUT are replaced through the
+# arr queue, at most QBIT_MAX_REPLACEMENTS per run.
+QBIT_URL = os.environ.get("QBIT_URL", "").strip().rstrip("/")
+QBIT_USER = os.environ.get("QBIT_USER", "")
+QBIT_PASS = os.environ.get("QBIT_PASS", "")
+QBIT_MONITOR_ENABLED = os.environ.get("QBIT_MONITOR_ENABLED", "").strip().lower() in ("1", "true", "yes")
+QBIT_MONITOR_INTERVAL = int(os.environ.get("QBIT_MONITOR_INTERVAL", "120"))
+QBIT_STALL_TIMEOUT = int(os.environ.get("QBIT_STALL_TIMEOUT", "3600"))
+QBIT_MAX_REPLACEMENTS = int(os.environ.get("QBIT_MAX_REPLACEMENTS", "3"))
 SONARR_MISSING_WEIGHT = int(os.environ.get("SONARR_MISSING_WEIGHT", "2"))
 RADARR_MISSING_WEIGHT = int(os.environ.get("RADARR_MISSING_WEIGHT", "1"))
+LIDARR_MISSING_WEIGHT = int(os.environ.get("LIDARR_MISSING_WEIGHT", "1"))
+PROCESSED_HISTORY_LIMIT = int(os.environ.get("PROCESSED_HISTORY_LIMIT", "500"))
+HTTP_MAX_IDLE_PER_HOST = int(os.environ.get("HTTP_MAX_IDLE_PER_HOST", "4"))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", "1.0"))
+# Upper bound on how long one service may hold up a cycle before its work is
+# abandoned until the next one.
+SERVICE_TIMEOUT = int(os.environ.get("SERVICE_TIMEOUT", "90"))
+# Port for the /metrics, /status and /webhook/* endpoints; 0 disables the
+# listener.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9797"))
+# When set, API responses the controllers depend on are appended to this
+# JSON-lines trace for scripts/arr-retry-sim.py to replay offline.
+TRACE_FILE = os.environ.get("TRACE_FILE", "").strip()
 
 
 def load_sab_api_key_from_file(path):
@@ -49,75 +154,765 @@ def load_sab_api_key_from_file(path):
 if not SAB_API_KEY:
     SAB_API_KEY = load_sab_api_key_from_file(SAB_API_KEY_FILE)
 
+# -------------------------------------------------------------------
+# ARR INSTANCES
+# -------------------------------------------------------------------
+# What differs between arr types: API root, the history/webhook item id key,
+# the per-item search command and its id list, whether episodes can be
+# promoted to season/series searches, extra /history and /queue parameters
+# and the wanted-missing sort key.
+ARR_TYPES = {
+    "sonarr": {
+        "api_path": "/api/v3",
+        "item_key": "episodeId",
+        "search_command": "EpisodeSearch",
+        "search_ids_key": "episodeIds",
+        "promotable": True,
+        "include_params": {"includeEpisode": "true"},
+        "missing_sort_key": "airDateUtc",
+    },
+    "radarr": {
+        "api_path": "/api/v3",
+        "item_key": "movieId",
+        "search_command": "MoviesSearch",
+        "search_ids_key": "movieIds",
+        "promotable": False,
+        "include_params": {},
+        "missing_sort_key": "airDateUtc",
+    },
+    "lidarr": {
+        "api_path": "/api/v1",
+        "item_key": "albumId",
+        "search_command": "AlbumSearch",
+        "search_ids_key": "albumIds",
+        "promotable": False,
+        "include_params": {},
+        "missing_sort_key": "releaseDate",
+    },
+}
+
+
+class ArrInstance:
+    """One configured Sonarr/Radarr/Lidarr server."""
+
+    def __init__(self, name, kind, url, api_key, weight=1):
+        self.name = name
+        self.kind = kind
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.weight = weight
+        for attr, value in ARR_TYPES[kind].items():
+            setattr(self, attr, value)
+        self.api_root = self.url + self.api_path
+
+
+def parse_arr_instances(spec):
+    instances = []
+    for entry in filter(None, (part.strip() for part in spec.split(";"))):
+        name, _, fields = entry.partition("=")
+        parts = [field.strip() for field in fields.split(",")]
+        name = name.strip()
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name) or len(parts) not in (3, 4):
+            raise ValueError(f"Bad ARR_INSTANCES entry {entry!r}; expected Name=type,url,api_key[,weight]")
+        kind = parts[0].lower()
+        if kind not in ARR_TYPES:
+            raise ValueError(f"Unknown arr type {parts[0]!r} for {name}; expected one of {', '.join(ARR_TYPES)}")
+        weight = int(parts[3]) if len(parts) == 4 and parts[3] else 1
+        instances.append(ArrInstance(name, kind, parts[1], parts[2], weight))
+    return instances
+
+
+def load_arr_instances():
+    if ARR_INSTANCES_SPEC:
+        instances = parse_arr_instances(ARR_INSTANCES_SPEC)
+    else:
+        instances = [
+            ArrInstance("Sonarr", "sonarr", SONARR_URL, SONARR_API_KEY, SONARR_MISSING_WEIGHT),
+            ArrInstance("Radarr", "radarr", RADARR_URL, RADARR_API_KEY, RADARR_MISSING_WEIGHT),
+        ]
+        # Lidarr is opt-in: only added once it has an API key.
+        if LIDARR_API_KEY:
+            instances.append(ArrInstance("Lidarr", "lidarr", LIDARR_URL, LIDARR_API_KEY, LIDARR_MISSING_WEIGHT))
+
+    names = [instance.name.lower() for instance in instances]
+    if len(set(names)) != len(names):
+        raise ValueError("ARR_INSTANCES names must be unique (case-insensitive)")
+    return {instance.name: instance for instance in instances}
+
+
+# Display name -> ArrInstance, in configuration order. The name prefixes the
+# instance's state keys ("sonarr_history_cursor", ...) and log lines.
+ARR_INSTANCES = load_arr_instances()
+
 # -------------------------------------------------------------------
 # STATE HELPERS
 # -------------------------------------------------------------------
+class ProcessedSet:
+    """
+    Bounded set of ids ordered by when they were last added. Re-adding an id
+    refreshes it, and once the limit is reached the least recently added ids
+    are evicted first. Changes are tracked so commits only touch what moved.
+    """
+
+    def __init__(self, limit, rows=()):
+        self.limit = limit
+        self._items = OrderedDict()
+        self._seq = 0
+        for item_id, seq in rows:
+            self._items[item_id] = seq
+            self._seq = max(self._seq, seq)
+        self._upserts = {}
+        self._deletes = set()
+
+    def __contains__(self, item_id):
+        return item_id in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def dirty(self):
+        return bool(self._upserts or self._deletes)
+
+    def add(self, item_id):
+        self._seq += 1
+        self._items[item_id] = self._seq
+        self._items.move_to_end(item_id)
+        self._upserts[item_id] = self._seq
+        self._deletes.discard(item_id)
+
+        while len(self._items) > self.limit:
+            evicted, _ = self._items.popitem(last=False)
+            self._upserts.pop(evicted, None)
+            self._deletes.add(evicted)
+
+    def clear(self):
+        self._deletes.update(self._items)
+        self._items.clear()
+        self._upserts.clear()
+
+    def take_changes(self):
+        upserts, deletes = self._upserts, self._deletes
+        self._upserts, self._deletes = {}, set()
+        return upserts, deletes
+
+
+class ItemTable:
+    """Persisted id -> dict records for one kind of item, with change tracking."""
+
+    def __init__(self, rows=()):
+        self._items = {item_id: json.loads(data) for item_id, data in rows}
+        self._upserts = set()
+        self._deletes = set()
+
+    def __contains__(self, item_id):
+        return item_id in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, item_id, default=None):
+        return self._items.get(item_id, default)
+
+    def items(self):
+        return self._items.items()
+
+    @property
+    def dirty(self):
+        return bool(self._upserts or self._deletes)
+
+    def set(self, item_id, value):
+        self._items[item_id] = value
+        self._upserts.add(item_id)
+        self._deletes.discard(item_id)
+
+    def discard(self, item_id):
+        if self._items.pop(item_id, None) is not None:
+            self._upserts.discard(item_id)
+            self._deletes.add(item_id)
+
+    def take_changes(self):
+        upserts = {item_id: self._items[item_id] for item_id in self._upserts}
+        deletes = self._deletes
+        self._upserts, self._deletes = set(), set()
+        return upserts, deletes
+
+
+PROCESSED_LIMITS = {
+    "sonarr_processed": PROCESSED_HISTORY_LIMIT,
+    "radarr_processed": PROCESSED_HISTORY_LIMIT,
+}
+
+
+class StateStore:
+    """
+    SQLite-backed state. Scalar/JSON values live in a key-value table and the
+    processed-id sets in their own table; both are mirrored in memory and
+    written back in a single transaction only when something changed, so a
+    crash can never leave a half-written state behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed ("
+            "name TEXT NOT NULL, item_id INTEGER NOT NULL, seq INTEGER NOT NULL, "
+            "PRIMARY KEY (name, item_id))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "name TEXT NOT NULL, item_id INTEGER NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (name, item_id))"
+        )
+        self.conn.commit()
+
+        self._values = {
+            key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM kv")
+        }
+        self._dirty_keys = set()
+        self._sets = {}
+        self._tables = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if self._values.get(key) != value:
+            self._values[key] = value
+            self._dirty_keys.add(key)
+
+    def processed(self, name):
+        if name not in self._sets:
+            rows = self.conn.execute(
+                "SELECT item_id, seq FROM processed WHERE name = ? ORDER BY seq", (name,)
+            ).fetchall()
+            self._sets[name] = ProcessedSet(PROCESSED_LIMITS.get(name, PROCESSED_HISTORY_LIMIT), rows)
+        return self._sets[name]
+
+    def items(self, name):
+        if name not in self._tables:
+            rows = self.conn.execute(
+                "SELECT item_id, data FROM items WHERE name = ?", (name,)
+            ).fetchall()
+            self._tables[name] = ItemTable(rows)
+        return self._tables[name]
+
+    def commit(self):
+        dirty_sets = [(name, s) for name, s in self._sets.items() if s.dirty]
+        dirty_tables = [(name, t) for name, t in self._tables.items() if t.dirty]
+        if not self._dirty_keys and not dirty_sets and not dirty_tables:
+            return False
+
+        with self.conn:
+            for key in self._dirty_keys:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (key, json.dumps(self._values[key])),
+                )
+            for name, processed in dirty_sets:
+                upserts, deletes = processed.take_changes()
+                self.conn.executemany(
+                    "DELETE FROM processed WHERE name = ? AND item_id = ?",
+                    [(name, item_id) for item_id in deletes],
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO processed (name, item_id, seq) VALUES (?, ?, ?)",
+                    [(name, item_id, seq) for item_id, seq in upserts.items()],
+                )
+            for name, table in dirty_tables:
+                upserts, deletes = table.take_changes()
+                self.conn.executemany(
+                    "DELETE FROM items WHERE name = ? AND item_id = ?",
+                    [(name, item_id) for item_id in deletes],
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO items (name, item_id, data) VALUES (?, ?, ?)",
+                    [(name, item_id, json.dumps(data)) for item_id, data in upserts.items()],
+                )
+        self._dirty_keys.clear()
+        return True
+
+    def table_sizes(self):
+        sizes = {"kv": len(self._values)}
+        for table in ("processed", "items"):
+            for name, count in self.conn.execute(f"SELECT name, COUNT(*) FROM {table} GROUP BY name"):
+                sizes[name] = count
+        return sizes
+
+    def import_legacy_json(self, path):
+        """One-time migration from the old state.json layout."""
+        try:
+            with open(path, "r") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print(f"[State] Could not read legacy {path}: {e}")
+            return
+
+        for key, value in legacy.items():
+            if key in PROCESSED_LIMITS and isinstance(value, list):
+                processed = self.processed(key)
+                for item_id in value:
+                    processed.add(item_id)
+            elif not key.endswith(("_next_search", "_missing_processed")):
+                self[key] = value
+
+        self.commit()
+        os.replace(path, f"{path}.migrated")
+        print(f"[State] Migrated {path} into {self.path}")
+
+
 def load_state():
     os.makedirs(STATE_DIR, exist_ok=True)
-    if not os.path.exists(STATE_FILE):
-        return {
-            "sonarr_processed": [],
-            "radarr_processed": [],
-            "sonarr_missing_processed": [],
-            "radarr_missing_processed": [],
-            "sonarr_missing_next_search": 0,
-            "radarr_missing_next_search": 0,
-            "missing_backfill_next_search": 0,
-        }
+    fresh = not os.path.exists(STATE_DB)
+    state = StateStore(STATE_DB)
+    if fresh and os.path.exists(STATE_FILE):
+        state.import_legacy_json(STATE_FILE)
+    return state
+
+# -------------------------------------------------------------------
+# METRICS
+# -------------------------------------------------------------------
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_HELP = {
+    "arr_retry_http_request_duration_seconds": ("histogram", "Upstream API request latency by endpoint."),
+    "arr_retry_http_requests_total": ("counter", "Upstream API requests by endpoint."),
+    "arr_retry_http_errors_total": ("counter", "Failed upstream API requests by endpoint."),
+    "arr_retry_http_response_bytes_total": ("counter", "Response bytes received by endpoint."),
+    "arr_retry_history_records_scanned_total": ("counter", "History records scanned per service."),
+    "arr_retry_searches_triggered_total": ("counter", "Items searched per service and kind."),
+    "arr_retry_searches_deferred_total": ("counter", "Items whose search was deferred per service."),
+    "arr_retry_search_rate_per_hour": ("gauge", "Current adaptive search rate limit."),
+    "arr_retry_backfill_budget": ("gauge", "Backfill budget computed on the last backfill run."),
+    "arr_retry_state_entries": ("gauge", "Rows held in the state store per table."),
+    "arr_retry_task_duration_seconds": ("histogram", "Scheduled task run time."),
+    "arr_retry_cycle_duration_seconds": ("histogram", "Wall time of one scheduler cycle."),
+    "arr_retry_webhooks_total": ("counter", "Webhook deliveries by source and event type."),
+    "arr_retry_failures_held_total": ("counter", "Failures not searched at once, by service and reason."),
+    "arr_retry_flagged_items": ("gauge", "Items flagged after too many failed retries, per service."),
+    "arr_retry_download_replacements_total": (
+        "counter", "Downloads removed, blocklisted and re-searched, by client and reason."
+    ),
+}
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms in Prometheus text format."""
+
+    def __init__(self, help_text):
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def total(self, name, **labels):
+        """Sum of a counter over every label set that includes `labels`."""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(
+                value for (key, key_labels), value in self._values.items()
+                if key == name and wanted <= set(key_labels)
+            )
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            histograms = [(key, (list(h[0]), h[1], h[2])) for key, h in histograms]
+
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen:
+                seen.add(name)
+                kind, text = self.help_text.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in values:
+            header(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name)
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(METRIC_HELP)
+
+# Snapshot of the most recent scheduler cycle, served as /status.
+STATUS = {"started_at": datetime.now(timezone.utc).isoformat(), "last_cycle": None, "flagged": {}}
+
+
+async def route_http(method, target, headers, body):
+    """Return (status line, content type, payload) for one request."""
+    if method == "GET" and target.path == "/metrics":
+        return "200 OK", "text/plain; version=0.0.4", METRICS.render().encode("utf-8")
+    if method == "GET" and target.path == "/status":
+        return "200 OK", "application/json", json.dumps(STATUS, indent=2).encode("utf-8")
+    if method == "POST" and WEBHOOKS_ENABLED and target.path in WEBHOOK_ROUTES:
+        return accept_webhook(WEBHOOK_ROUTES[target.path], target, headers, body)
+    return "404 Not Found", "text/plain", b"not found\n"
+
+
+async def serve_http(reader, writer):
+    """Minimal HTTP/1.1 handler: one request per connection."""
     try:
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {
-            "sonarr_processed": [],
-            "radarr_processed": [],
-            "sonarr_missing_processed": [],
-            "radarr_missing_processed": [],
-            "sonarr_missing_next_search": 0,
-            "radarr_missing_next_search": 0,
-            "missing_backfill_next_search": 0,
-        }
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        body = await asyncio.wait_for(reader.readexactly(length), 10) if length else b""
+        status, content_type, payload = await route_http(method, parse.urlsplit(target), headers, body)
+    except Exception as e:
+        status, content_type, payload = "400 Bad Request", "text/plain", f"{e}\n".encode("utf-8")
 
+    try:
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            + payload
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
-def save_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f)
+
+async def start_http_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(serve_http, "0.0.0.0", METRICS_PORT)
+    except OSError as e:
+        print(f"[Metrics] Could not listen on port {METRICS_PORT}: {e}")
+        return None
+    print(f"[Metrics] Serving /metrics, /status and /webhook/* on port {METRICS_PORT}")
+    return server
+
+# -------------------------------------------------------------------
+# HTTP CLIENT
+# -------------------------------------------------------------------
+# Endpoint label -> (timeout seconds, retries). Labels are the arr API path
+# without its query string, or "sab:<mode>" for SABnzbd. POST /command is not
+# retried so a slow-but-successful request never queues a duplicate search.
+HTTP_ENDPOINT_POLICY = {
+    "/history": (30, 2),
+    "/wanted/missing": (60, 2),
+    "/command": (15, 0),
+    "/queue": (30, 1),
+    "/queue/{id}": (30, 0),
+    "qbit:login": (15, 1),
+    "sab:queue": (20, 2),
+    "sab:history": (20, 1),
+}
+HTTP_DEFAULT_POLICY = (30, 1)
+
+# Errors that mean a pooled keep-alive connection was closed by the server
+# while idle; the request never reached it, so it is safe to resend once.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason, url):
+        super().__init__(f"HTTP {status} {reason} for {url}")
+        self.status = status
+
+
+class HttpClient:
+    """
+    Small keep-alive HTTP client shared by every API helper. Idle connections
+    are pooled per host, gzip responses are decoded transparently, and every
+    request's latency and wire size are recorded per endpoint label.
+    """
+
+    def __init__(self, max_idle_per_host=HTTP_MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def _checkout(self, scheme, netloc, timeout):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+
+        conn_cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return conn_cls(netloc, timeout=timeout), False
+
+    def _checkin(self, scheme, netloc, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _record(self, label, seconds, nbytes, ok):
+        with self._lock:
+            entry = self.stats.setdefault(
+                label, {"requests": 0, "errors": 0, "seconds": 0.0, "bytes": 0}
+            )
+            entry["requests"] += 1
+            entry["seconds"] += seconds
+            entry["bytes"] += nbytes
+            if not ok:
+                entry["errors"] += 1
+
+        METRICS.observe("arr_retry_http_request_duration_seconds", seconds, endpoint=label)
+        METRICS.inc("arr_retry_http_requests_total", endpoint=label)
+        METRICS.inc("arr_retry_http_response_bytes_total", nbytes, endpoint=label)
+        if not ok:
+            METRICS.inc("arr_retry_http_errors_total", endpoint=label)
+
+    def take_stats(self):
+        with self._lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def _send_once(self, method, url, headers, body, timeout, response_headers=None):
+        parts = parse.urlsplit(url)
+        target = parts.path or "/"
+        if parts.query:
+            target += f"?{parts.query}"
+
+        for attempt in range(2):
+            conn, reused = self._checkout(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                resp = conn.getresponse()
+                raw = resp.read()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(parts.scheme, parts.netloc, conn)
+            if response_headers is not None:
+                response_headers.update((name.lower(), value) for name, value in resp.getheaders())
+
+            if resp.status >= 400:
+                raise HttpError(resp.status, resp.reason, url)
+
+            if resp.getheader("Content-Encoding", "").lower() == "gzip":
+                return gzip.decompress(raw), len(raw)
+            return raw, len(raw)
+
+    def request(self, method, url, label, headers=None, body=None, response_headers=None):
+        timeout, retries = HTTP_ENDPOINT_POLICY.get(label, HTTP_DEFAULT_POLICY)
+        headers = dict(headers or {})
+        headers.setdefault("Accept-Encoding", "gzip")
+        headers.setdefault("Connection", "keep-alive")
+
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            try:
+                payload, nbytes = self._send_once(method, url, headers, body, timeout, response_headers)
+            except Exception as e:
+                self._record(label, time.monotonic() - started, 0, False)
+                retryable = not isinstance(e, HttpError) or e.status == 429 or e.status >= 500
+                if attempt >= retries or not retryable:
+                    raise
+                delay = HTTP_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"[HTTP] {method} {label} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            self._record(label, time.monotonic() - started, nbytes, True)
+            if TRACE is not None and method == "GET":
+                TRACE.record(label, url, payload)
+            return payload
+
+
+HTTP = HttpClient()
+
+
+def decode_json(payload):
+    if not payload:
+        return None
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def log_http_stats():
+    stats = HTTP.take_stats()
+    if not stats:
+        return
+
+    parts = []
+    for label, entry in sorted(stats.items(), key=lambda kv: -kv[1]["seconds"]):
+        parts.append(
+            f"{label}={entry['requests']}req/{entry['seconds']:.2f}s/"
+            f"{entry['bytes'] / 1024:.0f}KB"
+            + (f"/{entry['errors']}err" if entry["errors"] else "")
+        )
+    print(f"[HTTP] Cycle requests: {', '.join(parts)}")
+
+# -------------------------------------------------------------------
+# TRACE RECORDING
+# -------------------------------------------------------------------
+# Endpoints whose responses drive the failure and backfill controllers.
+TRACE_LABELS = ("/history", "/wanted/missing", "sab:queue", "sab:history")
+
+
+class TraceRecorder:
+    """
+    Appends {"t", "u", "b"} lines (time, URL, response body) to a plain
+    JSON-lines trace, so a daemon killed mid-run still leaves a readable
+    file (compress it afterwards if needed). A response identical to the
+    last one recorded for the same URL is not written again: the replay
+    serves the latest response at or before the virtual time, so unchanged
+    polls cost nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._last = {}
+        self._file = open(path, "a", encoding="utf-8")
+        self._write({
+            "t": time.time(),
+            "instances": [
+                {"name": i.name, "kind": i.kind, "url": i.url, "weight": i.weight}
+                for i in ARR_INSTANCES.values()
+            ],
+        })
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def record(self, label, url, payload):
+        if label not in TRACE_LABELS:
+            return
+        parts = parse.urlsplit(url)
+        # Never write SAB's API key into the trace.
+        query = parse.urlencode([(k, v) for k, v in parse.parse_qsl(parts.query) if k != "apikey"])
+        url = parse.urlunsplit(parts._replace(query=query))
+        body = payload.decode("utf-8", "replace")
+        digest = hash(body)
+        with self._lock:
+            if self._last.get(url) == digest:
+                return
+            self._last[url] = digest
+            self._write({"t": round(time.time(), 3), "u": url, "b": body})
+
+
+TRACE = None
+if TRACE_FILE:
+    TRACE = TraceRecorder(TRACE_FILE)
+    print(f"[Trace] Recording API responses to {TRACE_FILE}")
 
 # -------------------------------------------------------------------
 # API HELPERS
 # -------------------------------------------------------------------
-def api_get(base_url, api_key, path, params=None):
+def api_get(api_root, api_key, path, params=None):
     if params is None:
         params = {}
     qs = parse.urlencode(params)
-    url = f"{base_url}/api/v3{path}"
+    url = f"{api_root}{path}"
     if qs:
         url += f"?{qs}"
 
-    headers = {"X-Api-Key": api_key}
-    req = request.Request(url, headers=headers)
-    with request.urlopen(req, timeout=30) as resp:
-        return json.load(resp)
+    payload = HTTP.request("GET", url, path, headers={"X-Api-Key": api_key})
+    return json.loads(payload)
 
 
-def api_post(base_url, api_key, path, payload=None):
+def api_post(api_root, api_key, path, payload=None):
     data = b"" if payload is None else json.dumps(payload).encode("utf-8")
-    url = f"{base_url}/api/v3{path}"
+    url = f"{api_root}{path}"
 
     headers = {
         "X-Api-Key": api_key,
         "Content-Type": "application/json",
     }
 
-    req = request.Request(url, data=data, headers=headers, method="POST")
-    with request.urlopen(req, timeout=30) as resp:
-        body = resp.read()
-        if not body:
-            return None
-        try:
-            return json.loads(body.decode("utf-8"))
-        except:
-            return None
+    return decode_json(HTTP.request("POST", url, path, headers=headers, body=data))
+
+
+def api_delete(api_root, api_key, path, params=None):
+    qs = parse.urlencode(params or {})
+    url = f"{api_root}{path}"
+    if qs:
+        url += f"?{qs}"
+
+    # One label for every id, so /queue/123 and /queue/456 share stats.
+    label = re.sub(r"/\d+$", "/{id}", path)
+    return decode_json(HTTP.request("DELETE", url, label, headers={"X-Api-Key": api_key}))
 
 
 def sab_api_get(mode, extra_params=None):
@@ -130,9 +925,54 @@ def sab_api_get(mode, extra_params=None):
 
     qs = parse.urlencode(params)
     url = f"{SAB_URL}/api?{qs}"
-    req = request.Request(url)
-    with request.urlopen(req, timeout=20) as resp:
-        return json.load(resp)
+    return json.loads(HTTP.request("GET", url, f"sab:{mode}"))
+
+
+class QbitClient:
+    """
+    qBittorrent Web API on the shared HTTP client. Logs in on first use and
+    again whenever the SID cookie has expired (HTTP 403).
+    """
+
+    def __init__(self, url, username, password):
+        self.url = url
+        self.username = username
+        self.password = password
+        # None until logged in; "" when qBittorrent lets us in without one.
+        self.cookie = None
+
+    def _login(self):
+        response_headers = {}
+        body = parse.urlencode({"username": self.username, "password": self.password}).encode("utf-8")
+        payload = HTTP.request(
+            "POST",
+            f"{self.url}/api/v2/auth/login",
+            "qbit:login",
+            headers={"Content-Type": "application/x-www-form-urlencoded", "Referer": self.url},
+            body=body,
+            response_headers=response_headers,
+        )
+        if payload.strip() != b"Ok.":
+            raise RuntimeError("qBittorrent login rejected")
+        self.cookie = response_headers.get("set-cookie", "").split(";", 1)[0]
+
+    def get(self, path, params=None):
+        url = f"{self.url}/api/v2{path}"
+        if params:
+            url += f"?{parse.urlencode(params)}"
+        for attempt in range(2):
+            if self.cookie is None:
+                self._login()
+            headers = {"Cookie": self.cookie} if self.cookie else {}
+            try:
+                return json.loads(HTTP.request("GET", url, f"qbit:{path}", headers=headers))
+            except HttpError as e:
+                if e.status != 403 or attempt:
+                    raise
+                self.cookie = None
+
+
+QBIT = QbitClient(QBIT_URL, QBIT_USER, QBIT_PASS) if QBIT_URL else None
 
 # -------------------------------------------------------------------
 # PARSING HELPERS
@@ -216,114 +1056,526 @@ def is_radarr_failure(rec):
 
     return False
 
+
+def is_lidarr_failure(rec):
+    """Lidarr marks failures the same way Radarr does."""
+    return is_radarr_failure(rec)
+
+
+FAILURE_CLASSIFIERS = {
+    "sonarr": is_sonarr_failure,
+    "radarr": is_radarr_failure,
+    "lidarr": is_lidarr_failure,
+}
+
 # -------------------------------------------------------------------
-# SONARR HANDLER
+# HISTORY SCANNING
 # -------------------------------------------------------------------
-def handle_sonarr_failures(state):
-    if not SONARR_API_KEY:
-        print("[Sonarr] Missing API key")
-        return
+def is_behind_history_cursor(rec, cursor):
+    cursor_id = cursor.get("id") or 0
+    rec_id = rec.get("id") or 0
+    return bool(cursor_id) and rec_id <= cursor_id
 
-    since = datetime.now(timezone.utc) - timedelta(hours=LOOKBACK_HOURS)
 
-    try:
-        history = api_get(
-            SONARR_URL,
-            SONARR_API_KEY,
-            "/history",
-            {
-                "pageSize": 200,
-                "sortKey": "date",
-                "sortDir": "desc",
-            },
-        )
-    except Exception as e:
-        print(f"[Sonarr] Fetch error: {e}")
-        return
-
-    records = history.get("records", [])
+async def fetch_new_history_records(instance, cursor, since):
+    """
+    Page through /history newest-first, stopping once we pass the cursor
+    saved on the previous cycle or fall outside the lookback window.
+    Returns (unseen records newest first, the cursor to save).
 
-    print(f"[Sonarr] Retrieved {len(records)} history records")
+    If HISTORY_MAX_PAGES runs out first, the saved cursor keeps its old
+    floor and records where to resume; the next cycle carries on down to
+    that floor before moving the cursor to the newest record scanned.
+    """
+    cursor_dt = iso_to_dt(cursor["date"]) if cursor.get("date") else None
+    floor_dt = max(since, cursor_dt) if cursor_dt else since
+
+    # New records push older ones onto later pages, so resuming at the next
+    # page can repeat records but never skips one.
+    resume = cursor.get("resume")
+    first_page = resume["page"] if resume else 1
+    scanned_dt = iso_to_dt(resume["below"]) if resume and resume.get("below") else None
+
+    records = []
+    for page in range(first_page, first_page + HISTORY_MAX_PAGES):
+        params = {
+            "page": page,
+            "pageSize": HISTORY_PAGE_SIZE,
+            "sortKey": "date",
+            "sortDirection": "descending",
+        }
+        if HISTORY_EVENT_TYPE:
+            params["eventType"] = HISTORY_EVENT_TYPE
+        params.update(instance.include_params)
+
+        history = await asyncio.to_thread(api_get, instance.api_root, instance.api_key, "/history", params)
+        page_records = history.get("records", []) or []
+
+        reached_floor = False
+        for rec in page_records:
+            date_str = rec.get("date")
+            # Records sharing the cursor's timestamp may be interleaved, so
+            # only stop once we are strictly older than it.
+            if date_str and iso_to_dt(date_str) < floor_dt:
+                reached_floor = True
+                break
+            if is_behind_history_cursor(rec, cursor):
+                continue
+            if scanned_dt and date_str and iso_to_dt(date_str) > scanned_dt:
+                # Scanned before the page cap was hit, or newer than the
+                # resume point and left for once the backlog is done.
+                continue
+            records.append(rec)
+
+        total_records = history.get("totalRecords", 0) or 0
+        if (
+            reached_floor
+            or len(page_records) < HISTORY_PAGE_SIZE
+            or page * HISTORY_PAGE_SIZE >= total_records
+        ):
+            top = resume["top"] if resume else cursor
+            return records, advance_history_cursor(top, records)
+
+    top = advance_history_cursor(resume["top"] if resume else cursor, records)
+    below = next((rec["date"] for rec in reversed(records) if rec.get("date")), None)
+    floor = {key: cursor[key] for key in ("id", "date") if key in cursor}
+    print(
+        f"[{instance.name}] Stopped after {HISTORY_MAX_PAGES} pages of /history; "
+        f"resuming at page {page + 1} next cycle before moving the cursor"
+    )
+    return records, dict(floor, resume={
+        "page": page + 1,
+        "top": top,
+        "below": below or (resume or {}).get("below"),
+    })
 
-    processed = set(state.get("sonarr_processed", []))
-    new_processed = list(processed)
 
+def advance_history_cursor(cursor, records):
+    newest = {key: cursor[key] for key in ("id", "date") if key in cursor}
     for rec in records:
-        rec_id = rec.get("id")
-        if not rec_id or rec_id in processed:
-            continue
+        rec_id = rec.get("id") or 0
+        if rec_id > (newest.get("id") or 0) and rec.get("date"):
+            newest = {"id": rec_id, "date": rec["date"]}
+    return dict(newest)
 
-        # Only consider real failures
-        if not is_sonarr_failure(rec):
-            continue
+# -------------------------------------------------------------------
+# SEARCH BATCHING
+# -------------------------------------------------------------------
+def search_group(rec):
+    """(seriesId, seasonNumber) for an episode record, None otherwise."""
+    series_id = rec.get("seriesId")
+    season = rec.get("seasonNumber")
+    if season is None:
+        season = (rec.get("episode") or {}).get("seasonNumber")
+    if series_id and season is not None:
+        return series_id, season
+    return None
+
+
+def queue_search(batch, instance, item_id, group=None, backfill=False):
+    """
+    Add an item to this cycle's search batch. Returns False if it was already
+    queued by another handler.
+    """
+    entry = batch.setdefault(instance.name, {"instance": instance, "items": {}})
+    if item_id in entry["items"]:
+        return False
+    entry["items"][item_id] = {"group": group, "backfill": backfill}
+    return True
 
-        # Time window filter
-        date_str = rec.get("date")
-        if not date_str:
-            continue
 
-        if iso_to_dt(date_str) < since:
+def build_search_commands(instance, items):
+    """
+    Turn the queued items for one instance into as few /command payloads as
+    possible. Returns a list of (payload, item_ids) pairs.
+    """
+    command_name, item_key = instance.search_command, instance.search_ids_key
+
+    seasons = {}
+    if instance.promotable and SEARCH_SEASON_PROMOTE_MIN > 0:
+        for item_id, info in items.items():
+            if info["group"]:
+                seasons.setdefault(info["group"], []).append(item_id)
+
+    by_series = {}
+    for (series_id, season), ids in seasons.items():
+        if len(ids) >= SEARCH_SEASON_PROMOTE_MIN:
+            by_series.setdefault(series_id, []).append((season, ids))
+
+    commands = []
+    covered = set()
+    for series_id, season_groups in by_series.items():
+        if 0 < SEARCH_SERIES_PROMOTE_MIN_SEASONS <= len(season_groups):
+            # A series search also covers queued episodes of seasons too
+            # small to promote on their own.
+            series_ids = [
+                item_id for (group_series, _), ids in seasons.items() if group_series == series_id
+                for item_id in ids
+            ]
+            covered.update(series_ids)
+            commands.append(({"name": "SeriesSearch", "seriesId": series_id}, series_ids))
             continue
 
-        episode_id = rec.get("episodeId")
-        if not episode_id:
-            continue
+        for season, ids in season_groups:
+            covered.update(ids)
+            commands.append((
+                {"name": "SeasonSearch", "seriesId": series_id, "seasonNumber": season},
+                ids,
+            ))
+
+    # Failure retries go ahead of backfill items so they are sent first when
+    # the rate limiter only has room for part of the batch.
+    rest = sorted(
+        (item_id for item_id in items if item_id not in covered),
+        key=lambda item_id: items[item_id]["backfill"],
+    )
+    if rest:
+        commands.insert(0, ({"name": command_name, item_key: rest}, rest))
+
+    commands.sort(key=lambda command: all(items[item_id]["backfill"] for item_id in command[1]))
+    return commands
+
+
+def mark_backfill_searched(state, name, item_id):
+    """Record a backfill search and push the item's next attempt out."""
+    index = WANTED_MISSING_INDEX.get(name)
+    if index is not None:
+        index["pending"].pop(item_id, None)
+
+    now = time.time()
+    backoff = state.items(f"{name.lower()}_backfill")
+    searches = (backoff.get(item_id) or {}).get("searches", 0) + 1
+    delay = min(MISSING_ITEM_BACKOFF_MAX, MISSING_ITEM_BACKOFF_BASE * 2 ** min(searches - 1, 16))
+    backoff.set(item_id, {"searches": searches, "last_search": now, "next_eligible": now + delay})
 
-        print(f"[Sonarr] Triggering EpisodeSearch for ep {episode_id}")
 
+# -------------------------------------------------------------------
+# SEARCH RATE LIMITING
+# -------------------------------------------------------------------
+class TokenBucket:
+    """
+    Indexer query budget. The refill rate adapts: it halves whenever an arr
+    reports a search backlog and creeps back up while the queues are empty.
+    """
+
+    def __init__(self, rate_per_hour, burst):
+        self.max_rate = rate_per_hour / 3600.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost, partial=False):
+        """Spend up to cost tokens; returns how many were granted."""
+        self._refill()
+        available = int(self.tokens)
+        if available >= cost:
+            granted = cost
+        elif partial:
+            granted = available
+        else:
+            granted = 0
+        self.tokens -= granted
+        return granted
+
+    def slow_down(self):
+        self._refill()
+        self.rate = max(self.max_rate * 0.1, self.rate * 0.5)
+
+    def speed_up(self):
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+
+class CircuitBreaker:
+    """Stops sending commands to a service after repeated failures."""
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self):
+        return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            exponent = min(self.failures - CIRCUIT_FAILURE_THRESHOLD, 6)
+            cooldown = CIRCUIT_COOLDOWN * 2 ** exponent
+            self.open_until = time.monotonic() + cooldown
+            print(f"[{self.name}] Circuit open for {cooldown}s after {self.failures} failures")
+
+
+SEARCH_LIMITER = TokenBucket(SEARCH_RATE_PER_HOUR, SEARCH_BURST)
+CIRCUIT_BREAKERS = {}
+
+
+def fetch_command_queue_depth(instance):
+    commands = api_get(instance.api_root, instance.api_key, "/command") or []
+    return sum(
+        1
+        for command in commands
+        if command.get("status") in ("queued", "started")
+        and command.get("name", "").endswith("Search")
+    )
+
+
+def estimate_search_cost(payload, ids, items):
+    """Rough number of indexer queries a command will cause."""
+    if payload["name"] == "SeasonSearch":
+        return 1
+    if payload["name"] == "SeriesSearch":
+        return len({items[item_id]["group"] for item_id in ids})
+    return len(ids)
+
+
+def defer_searches(state, name, items, ids):
+    """
+    Park failure retries that could not be sent so the next failure scan
+    re-queues them. Backfill items need nothing: they simply stay eligible.
+    """
+    METRICS.inc("arr_retry_searches_deferred_total", len(ids), service=name)
+    deferred = state.items(f"{name.lower()}_deferred")
+    now = time.time()
+    for item_id in ids:
+        if not items[item_id]["backfill"] and item_id not in deferred:
+            deferred.set(item_id, {"group": items[item_id]["group"], "deferred_at": now})
+
+
+def requeue_deferred_searches(state, batch, instance):
+    for item_id, entry in list(state.items(f"{instance.name.lower()}_deferred").items()):
+        group = tuple(entry["group"]) if entry.get("group") else None
+        queue_search(batch, instance, item_id, group)
+
+
+async def flush_service_searches(state, name, entry):
+    instance = entry["instance"]
+    items = entry["items"]
+    breaker = CIRCUIT_BREAKERS.setdefault(name, CircuitBreaker(name))
+    if not breaker.allow():
+        print(f"[{name}] Circuit open, deferring {len(items)} search(es)")
+        defer_searches(state, name, items, items)
+        return
+
+    try:
+        depth = await asyncio.to_thread(fetch_command_queue_depth, instance)
+    except Exception as e:
+        print(f"[{name}] Command queue check failed ({e}), deferring {len(items)} search(es)")
+        breaker.record_failure()
+        defer_searches(state, name, items, items)
+        return
+
+    if depth >= COMMAND_QUEUE_MAX:
+        SEARCH_LIMITER.slow_down()
+        print(
+            f"[{name}] {depth} searches already queued/running, deferring {len(items)} "
+            f"(limiter now {SEARCH_LIMITER.rate * 3600:.0f}/h)"
+        )
+        defer_searches(state, name, items, items)
+        return
+    if depth == 0:
+        SEARCH_LIMITER.speed_up()
+
+    item_key = instance.search_ids_key
+    deferred = state.items(f"{name.lower()}_deferred")
+    index = WANTED_MISSING_INDEX.get(name)
+
+    commands = build_search_commands(instance, items)
+    for position, (payload, ids) in enumerate(commands):
+        per_item = item_key in payload
+        cost = estimate_search_cost(payload, ids, items)
+        granted = SEARCH_LIMITER.take(cost, partial=per_item)
+        if granted < cost:
+            if not granted:
+                print(f"[{name}] Rate limited, deferring {payload['name']} for {len(ids)} item(s)")
+                defer_searches(state, name, items, ids)
+                continue
+            print(f"[{name}] Rate limited, deferring {cost - granted} of {len(ids)} item(s)")
+            defer_searches(state, name, items, ids[granted:])
+            ids = ids[:granted]
+            payload = dict(payload, **{item_key: ids})
+
+        print(f"[{name}] Triggering {payload['name']} for {len(ids)} item(s): {ids}")
         try:
-            api_post(
-                SONARR_URL,
-                SONARR_API_KEY,
-                "/command",
-                {"name": "EpisodeSearch", "episodeIds": [episode_id]},
-            )
+            await asyncio.to_thread(api_post, instance.api_root, instance.api_key, "/command", payload)
         except Exception as e:
-            print(f"[Sonarr] EpisodeSearch error: {e}")
+            print(f"[{name}] {payload['name']} error: {e}")
+            breaker.record_failure()
+            defer_searches(state, name, items, ids)
+            if not breaker.allow():
+                for _, later_ids in commands[position + 1:]:
+                    defer_searches(state, name, items, later_ids)
+                return
+            continue
+
+        breaker.record_success()
+        backfill_count = sum(1 for item_id in ids if items[item_id]["backfill"])
+        METRICS.inc("arr_retry_searches_triggered_total", len(ids) - backfill_count, service=name, kind="retry")
+        METRICS.inc("arr_retry_searches_triggered_total", backfill_count, service=name, kind="backfill")
+        for item_id in ids:
+            deferred.discard(item_id)
+            # A failure retry for an item that is also pending backfill counts
+            # as its backfill search too.
+            if items[item_id]["backfill"] or (index is not None and item_id in index["pending"]):
+                mark_backfill_searched(state, name, item_id)
+
+
+async def flush_search_batch(state, batch):
+    """Send every queued search, one command per instance (or promoted group)."""
+    await asyncio.gather(*(
+        run_isolated(name, flush_service_searches(state, name, entry))
+        for name, entry in batch.items()
+        if entry["items"]
+    ))
+
+# -------------------------------------------------------------------
+# FAILURE RETRY BACKOFF
+# -------------------------------------------------------------------
+# Per-item retry state lives in the "<name>_retries" item table:
+#   attempts      -> retries searched so far
+#   last_retry    -> when the latest retry was searched
+#   next_eligible -> end of the cooldown that retry started
+#   pending       -> a failure arrived during the cooldown; search when it ends
+#   group         -> (seriesId, seasonNumber) for season promotion
+#   flagged       -> gave up after RETRY_MAX_ATTEMPTS; only an import clears it
+def retry_cooldown(attempts):
+    return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** min(attempts - 1, 16))
+
+
+def start_retry(state, name, item_id, entry, now):
+    """Count one more retry for the item; False if that flags it instead."""
+    if entry["attempts"] >= RETRY_MAX_ATTEMPTS:
+        entry.update(flagged=True, pending=False)
+        print(f"[{name}] Item {item_id} failed after {entry['attempts']} retries, flagging it")
+        state.items(f"{name.lower()}_retries").set(item_id, entry)
+        update_flagged_items(state, name)
+        return False
 
-        new_processed.append(rec_id)
+    entry["attempts"] += 1
+    entry.update(last_retry=now, next_eligible=now + retry_cooldown(entry["attempts"]), pending=False)
+    state.items(f"{name.lower()}_retries").set(item_id, entry)
+    return True
 
-    state["sonarr_processed"] = new_processed[-500:]
+
+def failure_retry_decision(entry, now, failed_at=None):
+    """
+    What a failure at `failed_at` (default now) means for an item's retry
+    state: "search" now, "cooldown" to hold it until the cooldown ends,
+    "coalesced" when it predates the last retry and is already covered by
+    it, or "flagged" when the item has been given up on.
+    """
+    if entry is None:
+        return "search"
+    if entry["flagged"]:
+        return "flagged"
+    if (now if failed_at is None else failed_at) < entry["last_retry"]:
+        return "coalesced"
+    if now < entry["next_eligible"]:
+        return "cooldown"
+    return "search"
+
+
+def admit_failure_retry(state, name, item_id, group=None, failed_at=None):
+    """
+    Decide whether a download failure is searched now. The first failure of
+    an item always is. Failures dated before the last retry are merged into
+    it, later ones during its cooldown are held and searched once it ends,
+    and flagged items are not searched at all.
+    """
+    retries = state.items(f"{name.lower()}_retries")
+    entry = retries.get(item_id)
+    now = time.time()
+    reason = failure_retry_decision(entry, now, failed_at)
+
+    if entry is None:
+        entry = {"attempts": 0, "last_retry": 0.0, "next_eligible": 0.0, "pending": False,
+                 "group": group, "flagged": False}
+        return start_retry(state, name, item_id, entry, now)
+
+    entry = dict(entry, group=group or entry.get("group"))
+    if reason == "cooldown":
+        entry["pending"] = True
+        retries.set(item_id, entry)
+        print(f"[{name}] Item {item_id} failed again, holding retry {entry['attempts'] + 1} "
+              f"for {entry['next_eligible'] - now:.0f}s")
+    elif reason == "search":
+        return start_retry(state, name, item_id, entry, now)
+
+    METRICS.inc("arr_retry_failures_held_total", service=name, reason=reason)
+    return False
+
+
+def queue_held_retries(state, batch, instance):
+    """Search items whose held retry has come out of cooldown."""
+    name = instance.name
+    retries = state.items(f"{name.lower()}_retries")
+    now = time.time()
+    for item_id, entry in list(retries.items()):
+        if entry["pending"] and entry["next_eligible"] <= now:
+            entry = dict(entry)
+            if start_retry(state, name, item_id, entry, now):
+                print(f"[{name}] Cooldown over, queueing retry {entry['attempts']} for item {item_id}")
+                group = tuple(entry["group"]) if entry.get("group") else None
+                queue_search(batch, instance, item_id, group)
+
+        # Quiet, unflagged items are forgotten once a full cooldown has passed.
+        elif not entry["pending"] and not entry["flagged"] and entry["next_eligible"] + RETRY_BACKOFF_MAX < now:
+            retries.discard(item_id)
+
+
+def update_flagged_items(state, name):
+    flagged = sorted(item_id for item_id, entry in state.items(f"{name.lower()}_retries").items() if entry["flagged"])
+    METRICS.set("arr_retry_flagged_items", len(flagged), service=name)
+    STATUS["flagged"][name] = flagged
 
 # -------------------------------------------------------------------
-# RADARR HANDLER
+# ARR FAILURE HANDLER
 # -------------------------------------------------------------------
-def handle_radarr_failures(state):
-    if not RADARR_API_KEY:
-        print("[Radarr] Missing API key")
+async def handle_arr_failures(instance, state, batch):
+    name = instance.name
+    if not instance.api_key:
+        print(f"[{name}] Missing API key")
         return
 
     since = datetime.now(timezone.utc) - timedelta(hours=LOOKBACK_HOURS)
 
+    cursor_key = f"{name.lower()}_history_cursor"
+    cursor = state.get(cursor_key) or {}
+
     try:
-        history = api_get(
-            RADARR_URL,
-            RADARR_API_KEY,
-            "/history",
-            {
-                "pageSize": 200,
-                "sortKey": "date",
-                "sortDir": "desc",
-            },
-        )
+        records, next_cursor = await fetch_new_history_records(instance, cursor, since)
     except Exception as e:
-        print(f"[Radarr] Fetch error: {e}")
-        return
+        raise ServiceUnavailable(f"Fetch error: {e}") from e
+
+    print(f"[{name}] Retrieved {len(records)} new history records")
+    METRICS.inc("arr_retry_history_records_scanned_total", len(records), service=name)
 
-    records = history.get("records", [])
+    requeue_deferred_searches(state, batch, instance)
+    queue_held_retries(state, batch, instance)
 
-    print(f"[Radarr] Retrieved {len(records)} history records")
+    item_key = instance.item_key
+    for rec in records:
+        note_wanted_missing_history(state, name, rec.get("eventType"), rec.get(item_key))
 
-    processed = set(state.get("radarr_processed", []))
-    new_processed = list(processed)
+    processed = state.processed(f"{name.lower()}_processed")
+    is_failure = FAILURE_CLASSIFIERS[instance.kind]
 
     for rec in records:
         rec_id = rec.get("id")
         if not rec_id or rec_id in processed:
             continue
 
-        # Only treat true failures
-        if not is_radarr_failure(rec):
+        # Only consider real failures
+        if not is_failure(rec):
             continue
 
         # Time window filter
@@ -334,108 +1586,731 @@ def handle_radarr_failures(state):
         if iso_to_dt(date_str) < since:
             continue
 
-        movie_id = rec.get("movieId")
-        if not movie_id:
+        item_id = rec.get(item_key)
+        if not item_id:
             continue
 
-        print(f"[Radarr] Triggering MoviesSearch for movie {movie_id}")
+        if retried_directly(state, name, item_id, date_str):
+            processed.add(rec_id)
+            continue
 
-        try:
-            api_post(
-                RADARR_URL,
-                RADARR_API_KEY,
-                "/command",
-                {"name": "MoviesSearch", "movieIds": [movie_id]},
-            )
-        except Exception as e:
-            print(f"[Radarr] MoviesSearch error: {e}")
+        if admit_failure_retry(state, name, item_id, search_group(rec), iso_to_dt(date_str).timestamp()):
+            print(f"[{name}] Queueing {instance.search_command} for {item_key} {item_id}")
+            queue_search(batch, instance, item_id, search_group(rec))
 
-        new_processed.append(rec_id)
+        processed.add(rec_id)
 
-    state["radarr_processed"] = new_processed[-500:]
+    state[cursor_key] = next_cursor
 
 
 # -------------------------------------------------------------------
-# WANTED-MISSING BACKFILL HANDLERS
+# WEBHOOK HANDLERS
 # -------------------------------------------------------------------
-def fetch_wanted_missing_records(base_url, api_key, endpoint):
-    page_size = 1000
-    first_page = api_get(
-        base_url,
-        api_key,
-        endpoint,
-        {
-            "page": 1,
-            "pageSize": page_size,
-            "sortKey": "airDateUtc",
-            "sortDirection": "ascending",
-        },
+# Webhook eventType -> the equivalent /history eventType. Lidarr calls its
+# failure event DownloadFailure.
+WEBHOOK_EVENT_TYPES = {
+    "Grab": "grabbed",
+    "Download": "downloadFolderImported",
+    "DownloadFailed": "downloadFailed",
+    "DownloadFailure": "downloadFailed",
+}
+
+# One route per instance ("/webhook/sonarr4k"), plus SABnzbd's.
+WEBHOOK_ROUTES = {f"/webhook/{name.lower()}": name for name in ARR_INSTANCES}
+WEBHOOK_ROUTES["/webhook/sab"] = "SAB"
+
+# Set by main_loop so webhook deliveries can reach the live state/scheduler.
+RUNTIME = {}
+WEBHOOK_TASKS = set()
+
+
+def parse_webhook_body(target, headers, body):
+    """Merge query string and JSON or form body into one dict."""
+    payload = dict(parse.parse_qsl(target.query))
+    if not body:
+        return payload
+    if "json" in headers.get("content-type", "") or body.lstrip()[:1] in (b"{", b"["):
+        decoded = json.loads(body)
+        if isinstance(decoded, dict):
+            payload.update(decoded)
+    else:
+        payload.update(parse.parse_qsl(body.decode("utf-8", "replace")))
+    return payload
+
+
+def accept_webhook(source, target, headers, body):
+    """Validate a delivery and hand it to a background task; reply at once."""
+    payload = parse_webhook_body(target, headers, body)
+    if WEBHOOK_TOKEN and WEBHOOK_TOKEN not in (payload.get("token"), headers.get("x-webhook-token")):
+        return "401 Unauthorized", "text/plain", b"bad token\n"
+    if "state" not in RUNTIME:
+        return "503 Service Unavailable", "text/plain", b"starting\n"
+
+    if source == "SAB":
+        coro = process_sab_notification(payload)
+    else:
+        coro = process_arr_webhook(source, payload)
+    task = asyncio.get_running_loop().create_task(run_isolated(f"{source} webhook", coro))
+    WEBHOOK_TASKS.add(task)
+    task.add_done_callback(WEBHOOK_TASKS.discard)
+    return "202 Accepted", "application/json", b'{"accepted": true}'
+
+
+def webhook_records(instance, payload):
+    """Translate a Sonarr/Radarr/Lidarr webhook into /history-shaped records."""
+    event_type = WEBHOOK_EVENT_TYPES.get(payload.get("eventType"))
+    if event_type is None:
+        return []
+
+    data = {"message": payload.get("message") or ""}
+    if instance.kind == "sonarr":
+        series_id = (payload.get("series") or {}).get("id")
+        return [
+            {
+                "eventType": event_type,
+                "episodeId": episode.get("id"),
+                "seriesId": series_id,
+                "episode": {"seasonNumber": episode.get("seasonNumber")},
+                "data": data,
+            }
+            for episode in payload.get("episodes") or []
+            if episode.get("id")
+        ]
+
+    if instance.kind == "lidarr":
+        return [
+            {"eventType": event_type, "albumId": album.get("id"), "data": data}
+            for album in payload.get("albums") or []
+            if album.get("id")
+        ]
+
+    movie_id = (payload.get("movie") or {}).get("id")
+    return [{"eventType": event_type, "movieId": movie_id, "data": data}] if movie_id else []
+
+
+def retried_directly(state, name, item_id, date_str):
+    """True if a webhook or the SAB monitor already re-searched this item after the failure."""
+    entry = state.items(f"{name.lower()}_webhook_retries").get(item_id)
+    return bool(entry) and entry["at"] >= iso_to_dt(date_str).timestamp()
+
+
+def note_direct_retry(state, name, item_id):
+    retries = state.items(f"{name.lower()}_webhook_retries")
+    now = time.time()
+    retries.set(item_id, {"at": now})
+
+    # Entries only matter while the matching history record is in the window.
+    horizon = now - LOOKBACK_HOURS * 3600
+    for stale_id, entry in list(retries.items()):
+        if entry["at"] < horizon:
+            retries.discard(stale_id)
+
+
+def wake_failure_scans(names, delay=0):
+    scheduler = RUNTIME.get("scheduler")
+    for task in RUNTIME.get("tasks", ()):
+        if task.name in names:
+            scheduler.wake(task, delay)
+
+
+async def process_arr_webhook(name, payload):
+    event = payload.get("eventType") or "unknown"
+    METRICS.inc("arr_retry_webhooks_total", source=name, event=event)
+    instance = ARR_INSTANCES[name]
+    if not instance.api_key:
+        print(f"[{name}] Webhook {event} ignored: missing API key")
+        return
+
+    state = RUNTIME["state"]
+    # Committed with the scheduled tasks once none is mid-cycle.
+    with state_cycle(state):
+        item_key = instance.item_key
+        is_failure = FAILURE_CLASSIFIERS[instance.kind]
+        records = webhook_records(instance, payload)
+        for rec in records:
+            note_wanted_missing_history(state, name, rec["eventType"], rec.get(item_key))
+
+        if WEBHOOK_EVENT_TYPES.get(event) == "downloadFailed" and not records:
+            # Nothing to act on directly; let the history scan pick it up now.
+            print(f"[{name}] Webhook {event} without item ids, reconciling history")
+            wake_failure_scans((name,))
+            return
+
+        batch = {}
+        for rec in records:
+            if not is_failure(rec):
+                continue
+            item_id = rec[item_key]
+            if admit_failure_retry(state, name, item_id, search_group(rec)):
+                print(f"[{name}] Webhook {event}: queueing search for {item_key} {item_id}")
+                queue_search(batch, instance, item_id, search_group(rec))
+            # Handled either way; the history scan must not count it again.
+            note_direct_retry(state, name, item_id)
+
+        if batch:
+            await flush_search_batch(state, batch)
+
+
+async def process_sab_notification(payload):
+    # SAB notification scripts pass (type, title, message); forwarders may
+    # use either the positional or the named form.
+    kind = (payload.get("type") or payload.get("notification_type") or "").lower()
+    METRICS.inc("arr_retry_webhooks_total", source="SAB", event=kind or "unknown")
+    if kind not in ("failed", "error"):
+        return
+
+    print(f"[SAB] Notification '{kind}' for {payload.get('title', '?')}, reconciling arr history "
+          f"in {SAB_NOTIFY_RECHECK_DELAY}s")
+    wake_failure_scans(ARR_INSTANCES, SAB_NOTIFY_RECHECK_DELAY)
+
+
+# -------------------------------------------------------------------
+# DOWNLOAD CLIENT MONITORS
+# -------------------------------------------------------------------
+# nzo_id -> {"mbleft", "since"} for downloading slots and nzo_id -> first
+# seen for jobs repairing. Kept in memory: after a restart the stall clocks
+# simply start again.
+SAB_WATCH = {"slots": {}, "repairing": {}}
+
+# Lower-cased download ids (SAB nzo_ids, torrent hashes) already dealt with.
+HANDLED_DOWNLOADS = OrderedDict()
+HANDLED_DOWNLOADS_LIMIT = 500
+
+QBIT_STALLED_STATES = {"stalledDL": "stalled", "metaDL": "fetching metadata", "forcedMetaDL": "fetching metadata"}
+QBIT_DOWNLOADING_STATES = ("downloading", "forcedDL", "queuedDL", "checkingDL", "allocating")
+
+
+def find_sab_problem_jobs(monitor):
+    """
+    Return ({nzo_id: (kind, reason)}, monitor) for SAB jobs worth replacing:
+    history jobs that failed since the last run, jobs stuck repairing for
+    SAB_REPAIR_TIMEOUT, and at most one downloading slot whose remaining size
+    has not shrunk for SAB_STALL_TIMEOUT. `monitor` is the saved
+    "sab_monitor" state (None on the first run) and is returned updated for
+    the caller to store.
+
+    Stalls only count while the queue as a whole is moving, so a news server
+    outage or expired account does not blocklist good releases one by one,
+    and only one stall is acted on per run.
+    """
+    queue = (sab_api_get("queue") or {}).get("queue", {})
+    history = (sab_api_get("history", {"limit": SAB_HISTORY_SAMPLE}) or {}).get("history", {})
+    now = time.time()
+    problems = {}
+
+    paused = bool(queue.get("paused")) or str(queue.get("status", "")).lower() == "paused"
+    watched = SAB_WATCH["slots"]
+    live = set()
+    stalled = []
+    moving = parse_float(queue.get("kbpersec"), 0.0) > 0
+    for slot in queue.get("slots") or []:
+        nzo_id = slot.get("nzo_id")
+        if not nzo_id:
+            continue
+        live.add(nzo_id)
+        mbleft = parse_float(slot.get("mbleft"), 0.0)
+        entry = watched.get(nzo_id)
+        downloading = not paused and str(slot.get("status", "")).lower() == "downloading"
+        if downloading and entry is not None and mbleft < entry["mbleft"]:
+            moving = True
+        if not downloading or entry is None or mbleft < entry["mbleft"]:
+            watched[nzo_id] = {"mbleft": mbleft, "since": now}
+        elif now - entry["since"] >= SAB_STALL_TIMEOUT:
+            stalled.append((entry["since"], nzo_id, mbleft))
+    for nzo_id in set(watched) - live:
+        del watched[nzo_id]
+    if stalled and not moving:
+        # Nothing is downloading at all: the server side is down, not the
+        # jobs. Restart the stall clocks so the outage itself is not counted.
+        print(f"[SAB] No download progress at all, not judging {len(stalled)} stalled job(s)")
+        for _, nzo_id, _ in stalled:
+            watched[nzo_id]["since"] = now
+    elif stalled:
+        since, nzo_id, mbleft = min(stalled)
+        problems[nzo_id] = ("stalled", f"no progress for {(now - since) / 60:.0f} min, {mbleft:.0f} MB left")
+
+    history_slots = history.get("slots") or []
+    if monitor is None:
+        # First run: failures already in the history predate the monitor.
+        newest = max((int(parse_float(slot.get("completed"), 0.0)) for slot in history_slots), default=0)
+        monitor = {"last_failed": newest}
+    monitor = dict(monitor)
+    last_failed = monitor["last_failed"]
+    repairing = SAB_WATCH["repairing"]
+    live = set()
+    for slot in history_slots:
+        nzo_id = slot.get("nzo_id")
+        status = str(slot.get("status", "")).lower()
+        completed = int(parse_float(slot.get("completed"), 0.0))
+        if not nzo_id:
+            continue
+        if status == "failed" and completed > last_failed:
+            problems[nzo_id] = ("failed", slot.get("fail_message") or "failed in SAB")
+            monitor["last_failed"] = max(monitor["last_failed"], completed)
+        elif status == "repairing":
+            live.add(nzo_id)
+            since = repairing.setdefault(nzo_id, now)
+            if now - since >= SAB_REPAIR_TIMEOUT:
+                problems[nzo_id] = ("repairing", f"repairing for {(now - since) / 60:.0f} min")
+    for nzo_id in set(repairing) - live:
+        del repairing[nzo_id]
+
+    problems = {nzo_id: problem for nzo_id, problem in problems.items() if nzo_id.lower() not in HANDLED_DOWNLOADS}
+    return problems, monitor
+
+
+def is_seedless_torrent(torrent):
+    """Downloading, but no seed is connected or known to the tracker."""
+    return (
+        torrent.get("state") in ("downloading", "forcedDL")
+        and not torrent.get("num_seeds")
+        and not torrent.get("num_complete")
     )
 
-    records = first_page.get("records", [])
-    page_count = (first_page.get("totalRecords", 0) + page_size - 1) // page_size
 
-    for page in range(2, page_count + 1):
-        next_page = api_get(
-            base_url,
-            api_key,
-            endpoint,
-            {
-                "page": page,
-                "pageSize": page_size,
-                "sortKey": "airDateUtc",
-                "sortDirection": "ascending",
-            },
+def find_stalled_torrents():
+    """
+    Return {hash: (kind, reason)} for torrents with no transfer for
+    QBIT_STALL_TIMEOUT that are stalled, still fetching metadata, or have no
+    seeds at all, oldest first and at most QBIT_MAX_REPLACEMENTS. Nothing is
+    reported while qBittorrent is disconnected (e.g. the VPN is down).
+    """
+    transfer = QBIT.get("/transfer/info") or {}
+    if transfer.get("connection_status") == "disconnected":
+        print("[qBittorrent] Disconnected, not judging stalled torrents")
+        return {}
+
+    now = time.time()
+    stalled = []
+    for torrent in QBIT.get("/torrents/info") or []:
+        torrent_hash = torrent.get("hash")
+        state = torrent.get("state", "")
+        if not torrent_hash or torrent_hash.lower() in HANDLED_DOWNLOADS:
+            continue
+        if state in QBIT_STALLED_STATES:
+            kind = QBIT_STALLED_STATES[state]
+        elif is_seedless_torrent(torrent):
+            kind = "no seeds"
+        else:
+            continue
+        idle = now - max(torrent.get("last_activity") or 0, torrent.get("added_on") or 0)
+        if idle >= QBIT_STALL_TIMEOUT:
+            stalled.append((-idle, torrent_hash, kind, torrent.get("name") or torrent_hash))
+
+    return {
+        torrent_hash: (kind, f"{name}, idle {-idle / 60:.0f} min")
+        for idle, torrent_hash, kind, name in sorted(stalled)[:QBIT_MAX_REPLACEMENTS]
+    }
+
+
+def get_torrent_queue_snapshot():
+    """Downloading torrents in the same shape as the SAB queue snapshot."""
+    if QBIT is None:
+        return None
+    try:
+        torrents = QBIT.get("/torrents/info") or []
+    except Exception as e:
+        print(f"[Backfill] qBittorrent fetch error: {e}")
+        return None
+
+    # Stalled and seedless torrents are left out: they hold a slot but will
+    # not drain.
+    active = [
+        torrent for torrent in torrents
+        if torrent.get("state") in QBIT_DOWNLOADING_STATES
+        and (torrent.get("amount_left") or 0) > 0
+        and not is_seedless_torrent(torrent)
+    ]
+    return {
+        "item_count": len(active),
+        "mbleft": sum(torrent["amount_left"] for torrent in active) / (1024 * 1024),
+        "kbpersec": sum(torrent.get("dlspeed") or 0 for torrent in active) / 1024,
+    }
+
+
+def fetch_arr_queue(instance):
+    params = {"page": 1, "pageSize": ARR_QUEUE_PAGE_SIZE}
+    params.update(instance.include_params)
+    return (api_get(instance.api_root, instance.api_key, "/queue", params) or {}).get("records") or []
+
+
+async def replace_arr_downloads(state, batch, instance, client, problems):
+    """
+    Remove this instance's queue entries for the problem downloads from the
+    download client with a blocklist, then search the affected items again.
+    The arr's own re-download is skipped when the retry backoff will search
+    or hold the item; otherwise (e.g. it is flagged) the arr searches itself.
+    Returns the download ids that belonged to this instance.
+    """
+    name = instance.name
+    records = await asyncio.to_thread(fetch_arr_queue, instance)
+
+    by_download = {}
+    for record in records:
+        download_id = (record.get("downloadId") or "").lower()
+        if download_id in problems:
+            by_download.setdefault(download_id, []).append(record)
+
+    retries = state.items(f"{name.lower()}_retries")
+    for download_id, entries in by_download.items():
+        kind, reason = problems[download_id]
+        title = entries[0].get("title") or download_id
+        print(f"[{name}] {client} download {title} {kind} ({reason}); removing with blocklist")
+        now = time.time()
+        skip_redownload = any(
+            failure_retry_decision(retries.get(record.get(instance.item_key)), now) in ("search", "cooldown")
+            for record in entries
+            if record.get(instance.item_key)
         )
-        records.extend(next_page.get("records", []))
+        # A season pack has one queue record per episode; removing one
+        # removes the download for all of them.
+        await asyncio.to_thread(
+            api_delete,
+            instance.api_root,
+            instance.api_key,
+            f"/queue/{entries[0]['id']}",
+            {"removeFromClient": "true", "blocklist": "true", "skipRedownload": str(skip_redownload).lower()},
+        )
+        METRICS.inc("arr_retry_download_replacements_total", service=name, client=client, reason=kind)
+
+        for record in entries:
+            item_id = record.get(instance.item_key)
+            if not item_id:
+                continue
+            if admit_failure_retry(state, name, item_id, search_group(record)):
+                queue_search(batch, instance, item_id, search_group(record))
+            note_direct_retry(state, name, item_id)
+
+    return set(by_download)
+
+
+async def replace_problem_downloads(state, batch, client, problems):
+    """Hand problem downloads ({id: (kind, reason)}) to every configured arr."""
+    problems = {download_id.lower(): problem for download_id, problem in problems.items()}
+    configured = [instance for instance in ARR_INSTANCES.values() if instance.api_key]
+    results = await asyncio.gather(*(
+        run_isolated(instance.name, replace_arr_downloads(state, batch, instance, client, problems))
+        for instance in configured
+    ))
+
+    matched = set().union(*(result for result in results if result))
+    complete = all(result is not None for result in results)
+    for download_id, (kind, reason) in problems.items():
+        if download_id not in matched:
+            if not complete:
+                # An arr could not be checked; try again next run.
+                continue
+            # Not grabbed by a configured arr (or already gone from its queue).
+            print(f"[{client}] {kind.capitalize()} download {download_id} ({reason}) not found in any arr queue")
+        HANDLED_DOWNLOADS[download_id] = True
+    while len(HANDLED_DOWNLOADS) > HANDLED_DOWNLOADS_LIMIT:
+        HANDLED_DOWNLOADS.popitem(last=False)
+
+
+async def handle_sab_monitor(state, batch):
+    try:
+        problems, monitor = await asyncio.to_thread(find_sab_problem_jobs, state.get("sab_monitor"))
+    except Exception as e:
+        raise ServiceUnavailable(f"SAB fetch error: {e}") from e
+    # Stored here on the event loop; the state store is not thread-safe.
+    state["sab_monitor"] = monitor
+    if problems:
+        await replace_problem_downloads(state, batch, "SAB", problems)
+    return None
 
-    return records
 
+async def handle_qbit_monitor(state, batch):
+    try:
+        problems = await asyncio.to_thread(find_stalled_torrents)
+    except Exception as e:
+        raise ServiceUnavailable(f"qBittorrent fetch error: {e}") from e
+    if problems:
+        await replace_problem_downloads(state, batch, "qBittorrent", problems)
+    return None
 
-def trigger_wanted_missing_batch(state, name, base_url, api_key, endpoint,
-                                 command_name, item_key, processed_key, max_searches):
-    if not api_key or max_searches <= 0:
-        return 0
+# -------------------------------------------------------------------
+# WANTED-MISSING BACKFILL HANDLERS
+# -------------------------------------------------------------------
+def wanted_missing_params(instance, page, page_size):
+    # Newest first, so the priority window leans towards recent releases.
+    return {
+        "page": page,
+        "pageSize": page_size,
+        "sortKey": instance.missing_sort_key,
+        "sortDirection": "descending",
+    }
+
+
+def fetch_wanted_missing_total(instance, endpoint):
+    page = api_get(instance.api_root, instance.api_key, endpoint, wanted_missing_params(instance, 1, 1))
+    return page.get("totalRecords", 0) or 0
 
+
+def compact_missing_record(record):
+    """Keep only what backfill needs from an episode/movie/album payload."""
+    released = (
+        record.get("airDateUtc")
+        or record.get("releaseDate")
+        or record.get("digitalRelease")
+        or record.get("physicalRelease")
+        or record.get("inCinemas")
+    )
     try:
-        records = fetch_wanted_missing_records(base_url, api_key, endpoint)
+        released_ts = iso_to_dt(released).timestamp() if released else None
+    except ValueError:
+        released_ts = None
+
+    return {
+        "group": search_group(record),
+        "released": released_ts,
+        "monitored": record.get("monitored", True),
+    }
+
+
+def backfill_priority(info, backoff_entry, now):
+    """
+    Score a wanted-missing item; higher is searched first. Recent releases
+    score highest, items not searched for a long time get a boost, every
+    fruitless search halves the score, and unmonitored items are demoted.
+    """
+    if info["released"]:
+        age_days = max(0.0, (now - info["released"]) / 86400)
+    else:
+        age_days = 3650.0
+    half_life = max(1.0, MISSING_RECENCY_HALF_LIFE_DAYS)
+    recency = half_life / (half_life + age_days)
+
+    if backoff_entry:
+        staleness = min(1.0, (now - backoff_entry["last_search"]) / max(1, MISSING_ITEM_BACKOFF_MAX))
+        fruitless = backoff_entry["searches"]
+    else:
+        staleness, fruitless = 1.0, 0
+
+    score = (2 * recency + staleness) * 0.5 ** fruitless
+    if not info["monitored"]:
+        score *= 0.2
+    return score
+
+
+# In-memory wanted-missing index per service, keyed by display name. It is
+# filled lazily, one page at a time, only as far as the search budget needs:
+#   total      -> the arr's totalRecords, adjusted for imports we have seen
+#   members    -> ids seen on the pages loaded so far (minus imports)
+#   pending    -> id -> compact_missing_record() for loaded items that are out
+#                 of backoff and not yet searched
+#   next_page  -> next /wanted/missing page to load
+#   soonest    -> earliest backoff expiry skipped since the walk restarted
+#   idle_until -> after a full walk found nothing, don't re-walk before this
+#   built_at   -> when the index was last reset
+WANTED_MISSING_INDEX = {}
+
+
+async def refresh_wanted_missing_index(state, instance, endpoint="/wanted/missing"):
+    """
+    Return the wanted-missing index for a service, resetting it when the TTL
+    has expired or the arr's totalRecords no longer matches what we know about.
+    Only a one-record probe is fetched here; pages are streamed on demand by
+    stream_wanted_missing_candidates.
+    """
+    name = instance.name
+    if not instance.api_key:
+        return None
+
+    now = time.time()
+    index = WANTED_MISSING_INDEX.get(name)
+
+    try:
+        total = await asyncio.to_thread(fetch_wanted_missing_total, instance, endpoint)
     except Exception as e:
         print(f"[{name}] Wanted-missing fetch error: {e}")
-        return 0
+        return None
 
-    if not records:
+    if index is not None and total == index["total"] and now - index["built_at"] < MISSING_INDEX_TTL:
+        return index
+
+    if not total:
         print(f"[{name}] No wanted-missing items")
-        state[processed_key] = []
-        return 0
 
-    processed = set(state.get(processed_key, []))
-    pending = [record for record in records if record.get("id") not in processed]
+    index = {
+        "instance": instance,
+        "endpoint": endpoint,
+        "total": total,
+        "members": set(),
+        "pending": {},
+        "next_page": 1,
+        "soonest": float("inf"),
+        "idle_until": 0.0,
+        "built_at": now,
+    }
+    WANTED_MISSING_INDEX[name] = index
+    print(f"[{name}] Wanted-missing index reset: {total} missing items")
+    return index
 
-    if not pending:
-        print(f"[{name}] Wanted-missing list exhausted, cycling back through list")
-        processed = set()
-        pending = records
 
-    triggered = 0
-    for record in pending:
-        item_id = record.get("id")
-        if not item_id:
-            continue
+async def stream_wanted_missing_candidates(state, name, index):
+    """
+    Yield (id, info) for wanted-missing items that are out of backoff, loading
+    the next page only once the caller has consumed everything already known.
+    At the end of the list the walk wraps to page 1 (once per call) to pick up
+    items whose backoff has since expired.
+    """
+    backoff = state.items(f"{name.lower()}_backfill")
+    now = time.time()
 
-        print(f"[{name}] Triggering {command_name} for wanted-missing item {item_id}")
-        try:
-            api_post(base_url, api_key, "/command", {"name": command_name, item_key: [item_id]})
-        except Exception as e:
-            print(f"[{name}] Wanted-missing search error for {item_id}: {e}")
+    for item_id, info in list(index["pending"].items()):
+        yield item_id, info
+
+    wrapped = False
+    while True:
+        if (index["next_page"] - 1) * MISSING_PAGE_SIZE >= index["total"]:
+            # Anything searched from here on is in backoff for at least the
+            # base delay, so that bounds how long a re-walk can be skipped.
+            index["idle_until"] = min(index["soonest"], now + MISSING_ITEM_BACKOFF_BASE)
+            if wrapped or now < index["idle_until"]:
+                return
+            prune_backfill_backoff(state, name, index)
+            index["next_page"] = 1
+            index["soonest"] = float("inf")
+            wrapped = True
+
+        instance = index["instance"]
+        page = await asyncio.to_thread(
+            api_get,
+            instance.api_root,
+            instance.api_key,
+            index["endpoint"],
+            wanted_missing_params(instance, index["next_page"], MISSING_PAGE_SIZE),
+        )
+        index["next_page"] += 1
+        index["total"] = page.get("totalRecords", index["total"]) or 0
+
+        records = page.get("records") or []
+        if not records:
+            index["next_page"] = index["total"] // MISSING_PAGE_SIZE + 2
             continue
 
-        processed.add(item_id)
-        triggered += 1
-        if triggered >= max_searches:
-            break
+        # Index the whole page before yielding, so items the caller stops
+        # short of are still pending next time.
+        fresh = []
+        for record in records:
+            item_id = record.get("id")
+            if not item_id:
+                continue
+            index["members"].add(item_id)
+            if item_id in index["pending"]:
+                continue
 
-    state[processed_key] = list(processed)[-2000:]
-    return triggered
+            entry = backoff.get(item_id)
+            if entry and entry["next_eligible"] > now:
+                index["soonest"] = min(index["soonest"], entry["next_eligible"])
+                continue
+
+            index["pending"][item_id] = compact_missing_record(record)
+            fresh.append(item_id)
+
+        for item_id in fresh:
+            if item_id in index["pending"]:
+                yield item_id, index["pending"][item_id]
+
+
+def prune_backfill_backoff(state, name, index):
+    """
+    Forget the search backoff of items a full walk of wanted/missing no
+    longer lists (unmonitored, deleted or found outside arr-retry), so the
+    table stays the size of the backlog. Items still in backoff are kept: a
+    page shifting under the walk can hide an item that is still wanted.
+    """
+    backoff = state.items(f"{name.lower()}_backfill")
+    now = time.time()
+    stale = [
+        item_id for item_id, entry in backoff.items()
+        if item_id not in index["members"] and entry["next_eligible"] <= now
+    ]
+    for item_id in stale:
+        backoff.discard(item_id)
+    if stale:
+        print(f"[{name}] Dropped search backoff for {len(stale)} items no longer wanted")
+
+
+def note_wanted_missing_history(state, name, event_type, item_id):
+    """
+    Drop grabbed/imported items from the index without rebuilding it. A grab
+    also ends the item's fruitless-search backoff.
+    """
+    if not item_id:
+        return
+
+    grabbed = event_type == "grabbed"
+    imported = event_type in (
+        "downloadFolderImported",
+        "seriesFolderImported",
+        "movieFolderImported",
+        "downloadImported",
+        "trackFileImported",
+    )
+    if not grabbed and not imported:
+        return
+
+    state.items(f"{name.lower()}_backfill").discard(item_id)
+    if imported:
+        retries = state.items(f"{name.lower()}_retries")
+        flagged = (retries.get(item_id) or {}).get("flagged")
+        retries.discard(item_id)
+        if flagged:
+            update_flagged_items(state, name)
+
+    index = WANTED_MISSING_INDEX.get(name)
+    if index is None:
+        return
+
+    index["pending"].pop(item_id, None)
+    if imported and item_id in index["members"]:
+        index["members"].discard(item_id)
+        index["total"] = max(0, index["total"] - 1)
+
+
+async def trigger_wanted_missing_batch(state, batch, name, index, max_searches):
+    """
+    Queue up to max_searches of the best-scoring eligible items, scoring only
+    a window of MISSING_PRIORITY_WINDOW x budget candidates so paging still
+    stops early.
+    """
+    if index is None or max_searches <= 0:
+        return 0
+
+    already_queued = batch.get(name, {}).get("items", {})
+    backoff = state.items(f"{name.lower()}_backfill")
+    window = max_searches * max(1, MISSING_PRIORITY_WINDOW)
+    now = time.time()
+
+    candidates = []
+    try:
+        async for item_id, info in stream_wanted_missing_candidates(state, name, index):
+            if item_id in already_queued:
+                continue
+
+            candidates.append((backfill_priority(info, backoff.get(item_id), now), item_id, info))
+            if len(candidates) >= window:
+                break
+    except Exception as e:
+        print(f"[{name}] Wanted-missing fetch error: {e}")
+
+    best = heapq.nlargest(max_searches, candidates, key=lambda candidate: candidate[0])
+    for _, item_id, info in best:
+        queue_search(batch, index["instance"], item_id, info["group"], backfill=True)
+
+    return len(best)
+
+
+def parse_sab_timeleft(value):
+    """Convert SAB's "[D:]H:MM:SS" timeleft into seconds."""
+    seconds = 0
+    try:
+        for part in str(value or "").split(":"):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        return 0
+    return seconds
 
 
 def get_sab_queue_snapshot():
@@ -448,164 +2323,459 @@ def get_sab_queue_snapshot():
         print(f"[Backfill] SAB queue fetch error: {e}")
         return None
 
+    # History only feeds the learned averages, so losing it is not fatal.
+    try:
+        history = (sab_api_get("history", {"limit": SAB_HISTORY_SAMPLE}) or {}).get("history", {})
+        history_slots = history.get("slots", []) or []
+    except Exception as e:
+        print(f"[Backfill] SAB history fetch error: {e}")
+        history_slots = []
+
     slots = queue.get("slots", []) or []
     return {
         "item_count": len(slots),
         "mbleft": parse_float(queue.get("mbleft"), 0.0),
+        "kbpersec": parse_float(queue.get("kbpersec"), 0.0),
+        "timeleft": parse_sab_timeleft(queue.get("timeleft")),
+        "paused": bool(queue.get("paused")) or str(queue.get("status", "")).lower() == "paused",
+        "history": [
+            {
+                "completed": int(parse_float(slot.get("completed"), 0.0)),
+                "mb": parse_float(slot.get("bytes"), 0.0) / (1024 * 1024),
+                "ok": str(slot.get("status", "")).lower() == "completed",
+            }
+            for slot in history_slots
+            if str(slot.get("status", "")).lower() in ("completed", "failed")
+        ],
     }
 
 
-def calculate_missing_backfill_budget(state):
-    now = time.time()
-    if now < state.get("missing_backfill_next_search", 0):
-        return 0
+def merge_torrent_queue(snapshot, torrents):
+    """
+    Fold downloading torrents into the SAB snapshot so the backfill budget
+    sees both queues: their remaining size and speed add to SAB's, and the
+    time left is recomputed from the combined rate.
+    """
+    if torrents is None:
+        return snapshot
+    if snapshot is None:
+        return dict(torrents, timeleft=0, paused=False, history=[])
+    if not torrents["item_count"]:
+        return snapshot
+    return dict(
+        snapshot,
+        item_count=snapshot["item_count"] + torrents["item_count"],
+        mbleft=snapshot["mbleft"] + torrents["mbleft"],
+        kbpersec=snapshot["kbpersec"] + torrents["kbpersec"],
+        timeleft=0,
+        # A paused SAB no longer stops backfill while torrents are moving.
+        paused=snapshot["paused"] and not torrents["kbpersec"],
+    )
+
+
+def update_sab_stats(state, snapshot):
+    """
+    Fold the latest SAB observations into the persisted moving averages:
+    download speed while active, size of completed grabs, and the share of
+    grabs that complete rather than fail. History jobs are only counted once.
+    """
+    stats = dict(state.get("sab_stats") or {
+        "mb_per_sec": 0.0,
+        "avg_grab_mb": float(SAB_ESTIMATED_MB_PER_GRAB),
+        "success_rate": 1.0,
+        "last_completed": 0,
+    })
+    if snapshot is None:
+        return stats
+
+    alpha = min(1.0, max(0.0, SAB_STATS_SMOOTHING))
+
+    def smooth(old, sample):
+        return old + alpha * (sample - old)
+
+    if snapshot["kbpersec"] > 0 and not snapshot["paused"]:
+        stats["mb_per_sec"] = smooth(stats["mb_per_sec"] or snapshot["kbpersec"] / 1024, snapshot["kbpersec"] / 1024)
 
-    snapshot = get_sab_queue_snapshot()
+    last_completed = stats["last_completed"]
+    for job in sorted(snapshot["history"], key=lambda job: job["completed"]):
+        if job["completed"] <= last_completed:
+            continue
+        stats["success_rate"] = smooth(stats["success_rate"], 1.0 if job["ok"] else 0.0)
+        if job["ok"] and job["mb"] > 0:
+            stats["avg_grab_mb"] = smooth(stats["avg_grab_mb"], job["mb"])
+        stats["last_completed"] = job["completed"]
+
+    state["sab_stats"] = stats
+    return stats
 
+
+def calculate_missing_backfill_budget(snapshot, stats):
+    """
+    Return (budget, seconds until the next backfill check).
+
+    The queue is topped up so that, at the current line speed, it still holds
+    work when the next check runs and the searches queued then have had time
+    to land (MISSING_MIN_INTERVAL + SAB_GRAB_LEAD_TIME). Each search is
+    expected to contribute the learned average grab size times the learned
+    success rate. The static SAB_MIN_QUEUE_* thresholds are only used until a
+    download speed has been observed.
+    """
     if snapshot is None:
         budget = max(0, min(MISSING_MAX_BATCH, MISSING_DEFAULT_BATCH))
-        state["missing_backfill_next_search"] = now + MISSING_MIN_INTERVAL
         print(
             "[Backfill] SAB queue visibility unavailable, "
             f"triggering fallback batch size={budget}"
         )
-        return budget
+        return budget, MISSING_MIN_INTERVAL
 
     queue_items = snapshot["item_count"]
     queue_mb = snapshot["mbleft"]
 
-    items_needed = max(0, SAB_MIN_QUEUE_ITEMS - queue_items)
-    mb_needed = max(0.0, float(SAB_MIN_QUEUE_MB) - queue_mb)
-    grabs_needed_by_size = int(math.ceil(mb_needed / max(1, SAB_ESTIMATED_MB_PER_GRAB)))
+    if snapshot["paused"]:
+        print(f"[Backfill] SAB queue paused: items={queue_items}, mbleft={queue_mb:.0f}, budget=0")
+        return 0, MISSING_IDLE_RECHECK_INTERVAL
+
+    live_rate = snapshot["kbpersec"] / 1024
+    rate = live_rate if live_rate > 0 else stats["mb_per_sec"]
+    expected_mb = max(1.0, stats["avg_grab_mb"] * max(0.05, stats["success_rate"]))
+    horizon = MISSING_MIN_INTERVAL + SAB_GRAB_LEAD_TIME
+
+    if rate > 0:
+        target_mb = rate * horizon
+        budget = int(math.ceil(max(0.0, target_mb - queue_mb) / expected_mb))
+        if queue_items == 0:
+            budget = max(1, budget)
+        queue_seconds = snapshot["timeleft"] if live_rate > 0 and snapshot["timeleft"] else queue_mb / rate
+    else:
+        target_mb = float(SAB_MIN_QUEUE_MB)
+        items_needed = max(0, SAB_MIN_QUEUE_ITEMS - queue_items)
+        grabs_needed_by_size = int(math.ceil(max(0.0, target_mb - queue_mb) / expected_mb))
+        budget = max(items_needed, grabs_needed_by_size)
+        queue_seconds = 0
 
-    budget = max(items_needed, grabs_needed_by_size)
     budget = max(0, min(MISSING_MAX_BATCH, budget))
 
-    next_check = MISSING_MIN_INTERVAL if budget > 0 else MISSING_IDLE_RECHECK_INTERVAL
-    state["missing_backfill_next_search"] = now + next_check
+    if budget > 0:
+        next_check = MISSING_MIN_INTERVAL
+    else:
+        # Come back just as the queue drains down to the refill horizon.
+        next_check = min(MISSING_IDLE_RECHECK_INTERVAL, max(MISSING_MIN_INTERVAL, queue_seconds - horizon))
 
     print(
         f"[Backfill] SAB queue: items={queue_items}, mbleft={queue_mb:.0f}, "
-        f"budget={budget}, next_check={next_check}s"
+        f"speed={rate:.1f}MB/s, target={target_mb:.0f}MB, "
+        f"grab~{stats['avg_grab_mb']:.0f}MB@{stats['success_rate']:.0%}, "
+        f"budget={budget}, next_check={next_check:.0f}s"
     )
-    return budget
+    return budget, next_check
 
 
-def split_backfill_budget(total_budget):
-    if total_budget <= 0:
-        return 0, 0
+def split_backfill_budget(total_budget, weights):
+    """
+    Split the backfill budget across instances in proportion to their
+    weights. Each instance in turn takes its rounded share of what is left
+    (at least one search if its weight is positive) and the last takes the
+    rest; later instances that end up with nothing then get one search from
+    the largest share while the budget allows. With two instances this is
+    the original Sonarr/Radarr split. Returns {name: budget}.
+    """
+    budgets = dict.fromkeys(weights, 0)
+    if total_budget <= 0 or not weights:
+        return budgets
+
+    names = list(weights)
+    remaining = total_budget
+    remaining_weight = sum(max(0, weight) for weight in weights.values())
+    for position, name in enumerate(names):
+        weight = max(0, weights[name])
+        if position == len(names) - 1:
+            share = remaining
+        else:
+            share = int(round(remaining * weight / max(1, remaining_weight)))
+            share = min(remaining, max(1 if weight > 0 else 0, share))
+        budgets[name] = share
+        remaining -= share
+        remaining_weight -= weight
+
+    if total_budget > 1:
+        for name in names[1:]:
+            if weights[name] > 0 and budgets[name] == 0:
+                donor = max(budgets, key=budgets.get)
+                if budgets[donor] <= 1:
+                    break
+                budgets[donor] -= 1
+                budgets[name] = 1
+
+    return budgets
+
+
+async def handle_missing_backfill(state, batch):
+    # SAB and every index probe are independent, so run them side by side;
+    # each index is then reused by the leftover-budget pass below.
+    configured = [instance for instance in ARR_INSTANCES.values() if instance.api_key]
+    snapshot, torrents, *indexes = await asyncio.gather(
+        run_isolated("SAB", asyncio.to_thread(get_sab_queue_snapshot)),
+        run_isolated("qBittorrent", asyncio.to_thread(get_torrent_queue_snapshot)),
+        *(run_isolated(instance.name, refresh_wanted_missing_index(state, instance)) for instance in configured),
+    )
+    snapshot = merge_torrent_queue(snapshot, torrents)
+    indexes = {instance.name: index for instance, index in zip(configured, indexes) if index is not None}
 
-    sonarr_enabled = bool(SONARR_API_KEY)
-    radarr_enabled = bool(RADARR_API_KEY)
+    if configured and not indexes:
+        raise ServiceUnavailable("Wanted-missing lists unavailable")
 
-    if sonarr_enabled and not radarr_enabled:
-        return total_budget, 0
-    if radarr_enabled and not sonarr_enabled:
-        return 0, total_budget
-    if not sonarr_enabled and not radarr_enabled:
-        return 0, 0
+    stats = update_sab_stats(state, snapshot)
+    budget, next_check = calculate_missing_backfill_budget(snapshot, stats)
+    METRICS.set("arr_retry_backfill_budget", budget)
+    if budget <= 0:
+        return next_check
 
-    total_weight = max(1, SONARR_MISSING_WEIGHT + RADARR_MISSING_WEIGHT)
-    sonarr_budget = int(round(total_budget * SONARR_MISSING_WEIGHT / total_weight))
-    sonarr_budget = max(1 if SONARR_MISSING_WEIGHT > 0 else 0, sonarr_budget)
-    sonarr_budget = min(total_budget, sonarr_budget)
-    radarr_budget = total_budget - sonarr_budget
+    budgets = split_backfill_budget(budget, {name: ARR_INSTANCES[name].weight for name in indexes})
 
-    if RADARR_MISSING_WEIGHT > 0 and radarr_budget == 0 and total_budget > 1:
-        radarr_budget = 1
-        sonarr_budget = total_budget - 1
+    counts = await asyncio.gather(*(
+        trigger_wanted_missing_batch(state, batch, name, index, budgets[name])
+        for name, index in indexes.items()
+    ))
+    triggered = dict(zip(indexes, counts))
 
-    return sonarr_budget, radarr_budget
+    # Reuse leftover budget with whichever instances still have candidates.
+    for name, index in indexes.items():
+        remaining = budget - sum(triggered.values())
+        if remaining <= 0:
+            break
+        triggered[name] += await trigger_wanted_missing_batch(state, batch, name, index, remaining)
 
+    per_instance = ", ".join(f"{name.lower()}={count}" for name, count in triggered.items())
+    print(f"[Backfill] Queued searches: {per_instance}, total={sum(triggered.values())}")
+    return next_check
 
-def handle_missing_backfill(state):
-    budget = calculate_missing_backfill_budget(state)
-    if budget <= 0:
-        return
+# -------------------------------------------------------------------
+# SCHEDULER
+# -------------------------------------------------------------------
+class ServiceUnavailable(Exception):
+    """Raised by a task when the service it depends on could not be reached."""
+
+
+class ScheduledTask:
+    def __init__(self, name, handler, interval):
+        self.name = name
+        self.handler = handler
+        self.interval = interval
+        self.failures = 0
+        self.due = None
+        # The asyncio task running it right now, if any.
+        self.running = None
+
+    def next_delay(self, requested=None):
+        if self.failures:
+            delay = min(TASK_MAX_BACKOFF, self.interval * 2 ** min(self.failures, 16))
+        else:
+            delay = self.interval if requested is None else requested
+        return max(1.0, delay * random.uniform(1 - TASK_JITTER, 1 + TASK_JITTER))
+
+
+class TaskScheduler:
+    """Min-heap of tasks keyed by their next monotonic due time."""
+
+    def __init__(self, tasks):
+        self._heap = []
+        self._seq = itertools.count()
+        # Set whenever the schedule changes, so the main loop can stop
+        # sleeping early when a webhook brings a task forward.
+        self.changed = asyncio.Event()
+        now = time.monotonic()
+        for task in tasks:
+            self.schedule(task, 0, now)
+
+    def schedule(self, task, delay, now=None):
+        due = (time.monotonic() if now is None else now) + delay
+        task.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), task))
+        self.changed.set()
+
+    def wake(self, task, delay=0):
+        """Bring a waiting task forward to run within `delay` seconds."""
+        if task.due is not None and task.due > time.monotonic() + delay:
+            self.schedule(task, delay)
+
+    def seconds_until_next(self):
+        if not self._heap:
+            return float(LOOP_INTERVAL)
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def pop_due(self):
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, task = heapq.heappop(self._heap)
+            # Entries superseded by a later schedule() or wake() are dropped.
+            if task.due == when and task.running is None:
+                task.due = None
+                due.append(task)
+        return due
+
+
+async def run_task(task, state, batch):
+    """Run one task and return the delay before it should run again."""
+    try:
+        requested = await asyncio.wait_for(task.handler(state, batch), SERVICE_TIMEOUT)
+    except (ServiceUnavailable, asyncio.TimeoutError) as e:
+        task.failures += 1
+        delay = task.next_delay()
+        reason = str(e) or f"Timed out after {SERVICE_TIMEOUT}s"
+        print(f"[{task.name}] {reason}; backing off {delay:.0f}s (failure #{task.failures})")
+        return delay
+    except Exception as e:
+        print(f"[{task.name}] Unexpected error: {e}")
+        return task.next_delay()
 
-    sonarr_budget, radarr_budget = split_backfill_budget(budget)
-
-    sonarr_triggered = trigger_wanted_missing_batch(
-        state,
-        "Sonarr",
-        SONARR_URL,
-        SONARR_API_KEY,
-        "/wanted/missing",
-        "EpisodeSearch",
-        "episodeIds",
-        "sonarr_missing_processed",
-        sonarr_budget,
-    )
+    if task.failures:
+        print(f"[{task.name}] Recovered after {task.failures} failed run(s)")
+        task.failures = 0
+    return task.next_delay(requested)
 
-    radarr_triggered = trigger_wanted_missing_batch(
-        state,
-        "Radarr",
-        RADARR_URL,
-        RADARR_API_KEY,
-        "/wanted/missing",
-        "MoviesSearch",
-        "movieIds",
-        "radarr_missing_processed",
-        radarr_budget,
-    )
 
-    remaining = budget - sonarr_triggered - radarr_triggered
-    if remaining > 0:
-        # Reuse leftover budget with whichever service still has candidates.
-        sonarr_triggered += trigger_wanted_missing_batch(
-            state,
-            "Sonarr",
-            SONARR_URL,
-            SONARR_API_KEY,
-            "/wanted/missing",
-            "EpisodeSearch",
-            "episodeIds",
-            "sonarr_missing_processed",
-            remaining,
-        )
-        remaining = budget - sonarr_triggered - radarr_triggered
-
-    if remaining > 0:
-        radarr_triggered += trigger_wanted_missing_batch(
-            state,
-            "Radarr",
-            RADARR_URL,
-            RADARR_API_KEY,
-            "/wanted/missing",
-            "MoviesSearch",
-            "movieIds",
-            "radarr_missing_processed",
-            remaining,
-        )
+async def timed_phase(phases, name, coro):
+    started = time.monotonic()
+    try:
+        return await coro
+    finally:
+        phases[name] = round(time.monotonic() - started, 3)
+
+
+async def run_due_tasks(scheduler, tasks, state, phases):
+    # Runs tasks in lockstep with one shared search batch, for the simulator
+    # and benchmark; the daemon runs each task on its own (run_scheduled_task).
+    batch = {}
+    delays = await asyncio.gather(*(
+        timed_phase(phases, task.name, run_task(task, state, batch)) for task in tasks
+    ))
+    for task, delay in zip(tasks, delays):
+        scheduler.schedule(task, delay)
+        METRICS.observe("arr_retry_task_duration_seconds", phases[task.name], task=task.name)
+
+    await timed_phase(phases, "flush", flush_search_batch(state, batch))
 
-    print(
-        f"[Backfill] Triggered searches: sonarr={sonarr_triggered}, "
-        f"radarr={radarr_triggered}, total={sonarr_triggered + radarr_triggered}"
-    )
 
 # -------------------------------------------------------------------
 # MAIN LOOP
 # -------------------------------------------------------------------
-def main_loop():
+# Handler+flush sequences in progress. The state is only committed when none
+# is open, so a commit never persists a cycle that has recorded its work
+# (processed ids, cursors, retry attempts) but not yet sent its searches.
+STATE_CYCLES = {"open": 0}
+
+
+@contextlib.contextmanager
+def state_cycle(state, phases=None):
+    STATE_CYCLES["open"] += 1
+    try:
+        yield
+    finally:
+        STATE_CYCLES["open"] -= 1
+    if STATE_CYCLES["open"]:
+        return
+
+    started = time.monotonic()
+    state.commit()
+    if phases is not None:
+        phases["commit"] = round(time.monotonic() - started, 3)
+    log_http_stats()
+    for table, count in state.table_sizes().items():
+        METRICS.set("arr_retry_state_entries", count, table=table)
+
+
+async def run_scheduled_task(scheduler, task, state):
+    """
+    Run one due task with its own search batch, flush it and reschedule the
+    task, without holding up tasks that come due meanwhile.
+    """
+    started = time.monotonic()
+    phases = {}
+    batch = {}
+    delay = None
+    try:
+        with state_cycle(state, phases):
+            delay = await timed_phase(phases, task.name, run_task(task, state, batch))
+            await timed_phase(phases, "flush", flush_search_batch(state, batch))
+    except Exception as e:
+        print(f"[Main] Unexpected error: {e}")
+    finally:
+        task.running = None
+        scheduler.schedule(task, task.next_delay() if delay is None else delay)
+
+    elapsed = time.monotonic() - started
+    METRICS.observe("arr_retry_task_duration_seconds", phases.get(task.name, elapsed), task=task.name)
+    METRICS.observe("arr_retry_cycle_duration_seconds", elapsed)
+    METRICS.set("arr_retry_search_rate_per_hour", round(SEARCH_LIMITER.rate * 3600, 1))
+    STATUS["last_cycle"] = {
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "tasks": [task.name],
+        "duration": round(elapsed, 3),
+        "phases": phases,
+        "task_failures": {task.name: task.failures for task in RUNTIME.get("tasks", ())},
+    }
+    print(f"[Main] Ran {task.name} in {elapsed:.2f}s")
+
+
+async def run_isolated(name, coro, timeout=SERVICE_TIMEOUT):
+    """
+    Await one service's work without letting it stall or break the others.
+    Returns None if it times out or raises.
+    """
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        print(f"[{name}] Timed out after {timeout}s, skipping until next cycle")
+    except Exception as e:
+        print(f"[{name}] Unexpected error: {e}")
+    return None
+
+
+async def main_loop():
     state = load_state()
     print("arr-retry started; watching for failed downloads...")
     print(
-        f"Loop interval: {LOOP_INTERVAL}s, lookback: {LOOKBACK_HOURS}h, "
+        f"Failure check interval: {FAILURE_CHECK_INTERVAL}s, lookback: {LOOKBACK_HOURS}h, "
         f"missing min interval: {MISSING_MIN_INTERVAL}s, "
         f"missing max batch: {MISSING_MAX_BATCH}"
     )
 
+    failure_interval = FAILURE_CHECK_INTERVAL
+    if WEBHOOKS_ENABLED:
+        failure_interval = RECONCILE_INTERVAL
+        print(f"Webhooks enabled; history reconciliation every {RECONCILE_INTERVAL}s")
+        if not WEBHOOK_TOKEN:
+            print("[Main] WEBHOOK_TOKEN is not set; webhook deliveries are not authenticated")
+
+    tasks = [ScheduledTask("Backfill", handle_missing_backfill, MISSING_MIN_INTERVAL)]
+    if SAB_MONITOR_ENABLED and SAB_API_KEY:
+        tasks.append(ScheduledTask("SABMonitor", handle_sab_monitor, SAB_MONITOR_INTERVAL))
+    if QBIT_MONITOR_ENABLED and QBIT is not None:
+        tasks.append(ScheduledTask("QbitMonitor", handle_qbit_monitor, QBIT_MONITOR_INTERVAL))
+    for instance in ARR_INSTANCES.values():
+        update_flagged_items(state, instance.name)
+        if instance.api_key:
+            handler = functools.partial(handle_arr_failures, instance)
+            tasks.append(ScheduledTask(instance.name, handler, failure_interval))
+        else:
+            print(f"[{instance.name}] Missing API key")
+
+    scheduler = TaskScheduler(tasks)
+    RUNTIME.update(state=state, scheduler=scheduler, tasks=tasks)
+    await start_http_server()
+
     while True:
+        scheduler.changed.clear()
         try:
-            handle_sonarr_failures(state)
-            handle_radarr_failures(state)
-            handle_missing_backfill(state)
-            save_state(state)
-        except Exception as e:
-            print(f"[Main] Unexpected error: {e}")
-
-        time.sleep(LOOP_INTERVAL)
+            await asyncio.wait_for(scheduler.changed.wait(), scheduler.seconds_until_next())
+        except asyncio.TimeoutError:
+            pass
+        # Each due task runs on its own, so a slow or hung service does not
+        # delay the others; it is rescheduled when it finishes.
+        for task in scheduler.pop_due():
+            task.running = asyncio.create_task(run_scheduled_task(scheduler, task, state))
 
 
 if __name__ == "__main__":
-    main_loop()
\ No newline at end of file
+    asyncio.run(main_loop())
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for arr-retry and the unmanic watchdog.
+
+Starts stand-in Sonarr, Radarr, SABnzbd and Tautulli servers in a child
+process, points the real handlers at them and reports, per cycle, wall time,
+request count and bytes received, plus the peak RSS of the benchmarked
+process. Nothing outside this machine is contacted.
+
+    python3 scripts/benchmark.py --episodes 50000 --failures 500 --latency 20
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# -------------------------------------------------------------------
+# DATASETS
+# -------------------------------------------------------------------
+def iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def build_arr_dataset(kind, missing, failures, noise):
+    """History (newest first) and wanted-missing records for one arr."""
+    now = datetime.now(timezone.utc)
+    wanted = []
+    for i in range(missing):
+        released = iso(now - timedelta(hours=6 * i))
+        if kind == "sonarr":
+            wanted.append({
+                "id": i + 1,
+                "seriesId": i // 200 + 1,
+                "seasonNumber": (i // 20) % 10 + 1,
+                "airDateUtc": released,
+                "monitored": i % 17 != 0,
+            })
+        else:
+            wanted.append({"id": i + 1, "digitalRelease": released, "monitored": i % 17 != 0})
+
+    history = []
+    total = failures + noise
+    for i in range(total):
+        item_id = i % max(1, missing) + 1
+        record = {
+            "id": total - i,
+            "date": iso(now - timedelta(seconds=30 * i)),
+            # Failures are spread through the noise so paging has to find them.
+            "eventType": "downloadFailed" if i % max(1, total // max(1, failures)) == 0 else "grabbed",
+            "data": {"message": "Download failed"},
+        }
+        if kind == "sonarr":
+            record.update({
+                "episodeId": item_id,
+                "seriesId": (item_id - 1) // 200 + 1,
+                "episode": {"seasonNumber": ((item_id - 1) // 20) % 10 + 1},
+            })
+        else:
+            record["movieId"] = item_id
+        history.append(record)
+
+    return {"history": history, "wanted": wanted}
+
+
+def build_sab_dataset(queue_items, kbpersec):
+    now = int(time.time())
+    return {
+        "queue": {
+            "slots": [{"nzo_id": f"SABnzbd_nzo_{i}", "mb": "4000"} for i in range(queue_items)],
+            "mbleft": str(queue_items * 4000),
+            "kbpersec": str(kbpersec),
+            "timeleft": "0:30:00",
+            "paused": False,
+            "status": "Downloading",
+        },
+        "history": {
+            "slots": [
+                {
+                    "nzo_id": f"SABnzbd_nzo_h{i}",
+                    "bytes": 6 * 1024 ** 3,
+                    "status": "Failed" if i % 10 == 0 else "Completed",
+                    "completed": now - 600 * i,
+                }
+                for i in range(50)
+            ],
+        },
+    }
+
+
+def build_tautulli_dataset(sessions):
+    decisions = ("transcode", "copy", "direct play")
+    return {
+        "response": {
+            "result": "success",
+            "data": {
+                "stream_count": str(sessions),
+                "sessions": [
+                    {
+                        "session_key": str(i),
+                        "transcode_decision": decisions[i % len(decisions)],
+                        "stream_video_decision": decisions[i % len(decisions)],
+                        "video_resolution": "1080",
+                    }
+                    for i in range(sessions)
+                ],
+            },
+        },
+    }
+
+# -------------------------------------------------------------------
+# FAKE SERVERS
+# -------------------------------------------------------------------
+def make_handler(kind, dataset, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def query(self):
+            parts = parse.urlsplit(self.path)
+            return parts.path, {k: v[0] for k, v in parse.parse_qs(parts.query).items()}
+
+        def do_GET(self):
+            time.sleep(latency)
+            path, params = self.query()
+
+            if kind == "sab":
+                mode = params.get("mode")
+                if mode == "history":
+                    limit = int(params.get("limit", 50))
+                    return self.send_json({"history": {"slots": dataset["history"]["slots"][:limit]}})
+                return self.send_json({"queue": dataset["queue"]})
+
+            if kind == "tautulli":
+                return self.send_json(dataset)
+
+            if path.endswith("/command"):
+                return self.send_json([])
+
+            if path.endswith("/history"):
+                records = dataset["history"]
+                if params.get("eventType"):
+                    records = [r for r in records if r["eventType"] == "downloadFailed"]
+            elif path.endswith("/wanted/missing"):
+                records = dataset["wanted"]
+            else:
+                return self.send_json({"error": "not found"}, 404)
+
+            page = int(params.get("page", 1))
+            size = int(params.get("pageSize", 10))
+            self.send_json({
+                "page": page,
+                "pageSize": size,
+                "totalRecords": len(records),
+                "records": records[(page - 1) * size:page * size],
+            })
+
+        def do_POST(self):
+            time.sleep(latency)
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            self.send_json({"id": 1, "name": payload.get("name"), "status": "queued"}, 201)
+
+    return Handler
+
+
+def serve_fakes(args, ports):
+    datasets = {
+        "sonarr": build_arr_dataset("sonarr", args.episodes, args.failures, args.noise),
+        "radarr": build_arr_dataset("radarr", args.movies, args.failures, args.noise),
+        "sab": build_sab_dataset(args.sab_items, args.sab_kbpersec),
+        "tautulli": build_tautulli_dataset(args.sessions),
+    }
+    servers = []
+    for kind, dataset in datasets.items():
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(kind, dataset, args.latency / 1000))
+        server.daemon_threads = True
+        servers.append(server)
+        ports[kind] = server.server_port
+
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports["ready"] = True
+    while True:
+        time.sleep(3600)
+
+
+def start_fakes(args):
+    manager = multiprocessing.Manager()
+    ports = manager.dict()
+    process = multiprocessing.Process(target=serve_fakes, args=(args, ports), daemon=True)
+    process.start()
+    while not ports.get("ready"):
+        if not process.is_alive():
+            sys.exit("Fake servers failed to start")
+        time.sleep(0.05)
+    return process, {kind: f"http://127.0.0.1:{port}" for kind, port in ports.items() if kind != "ready"}
+
+# -------------------------------------------------------------------
+# BENCHMARKS
+# -------------------------------------------------------------------
+def load_script(module_name, filename):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPTS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def bench_arr_retry(args, urls):
+    os.environ.update({
+        "SONARR_URL": urls["sonarr"],
+        "RADARR_URL": urls["radarr"],
+        "SAB_URL": urls["sab"],
+        "SONARR_API_KEY": "bench",
+        "RADARR_API_KEY": "bench",
+        "SAB_API_KEY": "bench",
+        "METRICS_PORT": "0",
+    })
+    arr = load_script("arr_retry", "arr-retry.py")
+
+    state_dir = tempfile.mkdtemp(prefix="arr-bench-")
+    arr.STATE_DIR = state_dir
+    arr.STATE_FILE = os.path.join(state_dir, "state.json")
+    arr.STATE_DB = os.path.join(state_dir, "state.db")
+    if args.unlimited_searches:
+        arr.SEARCH_LIMITER = arr.TokenBucket(10 ** 9, 10 ** 9)
+
+    state = arr.load_state()
+    tasks = [
+        arr.ScheduledTask(name, functools.partial(arr.handle_arr_failures, instance), arr.FAILURE_CHECK_INTERVAL)
+        for name, instance in arr.ARR_INSTANCES.items()
+    ]
+    tasks.append(arr.ScheduledTask("Backfill", arr.handle_missing_backfill, arr.MISSING_MIN_INTERVAL))
+    scheduler = arr.TaskScheduler([])
+
+    results = []
+    for cycle in range(args.cycles):
+        arr.HTTP.take_stats()
+        phases = {}
+        started = time.perf_counter()
+        await arr.run_due_tasks(scheduler, tasks, state, phases)
+        state.commit()
+        elapsed = time.perf_counter() - started
+
+        stats = arr.HTTP.take_stats()
+        results.append({
+            "cycle": cycle + 1,
+            "wall_seconds": round(elapsed, 3),
+            "requests": sum(entry["requests"] for entry in stats.values()),
+            "bytes": sum(entry["bytes"] for entry in stats.values()),
+            "phases": phases,
+            "endpoints": {label: entry["requests"] for label, entry in sorted(stats.items())},
+        })
+
+    return results
+
+
+async def bench_watchdog(args, urls):
+    os.environ.update({"TAUTULLI_URL": urls["tautulli"], "TAUTULLI_API_KEY": "bench", "METRICS_PORT": "0"})
+    watchdog = load_script("unmanic_watchdog", "unmanic_watchdog.py")
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.polls):
+        poll_started = time.perf_counter()
+        await watchdog.tautulli_transcode_load()
+        latencies.append(time.perf_counter() - poll_started)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "polls": args.polls,
+        "wall_seconds": round(elapsed, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+    }
+
+
+def print_report(report):
+    print(f"\narr-retry ({report['config']['episodes']} episodes, {report['config']['movies']} movies, "
+          f"{report['config']['failures']} failures/arr, {report['config']['latency']}ms latency)")
+    print(f"{'cycle':>5} {'wall s':>8} {'requests':>9} {'KiB':>9}  phases")
+    for row in report["arr_retry"]:
+        phases = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in row["phases"].items())
+        print(f"{row['cycle']:>5} {row['wall_seconds']:>8.3f} {row['requests']:>9} "
+              f"{row['bytes'] / 1024:>9.0f}  {phases}")
+
+    watchdog = report["watchdog"]
+    print("\nwatchdog")
+    print(f"  {watchdog['polls']} Tautulli polls in {watchdog['wall_seconds']:.3f}s, "
+          f"p50={watchdog['p50_ms']}ms p99={watchdog['p99_ms']}ms")
+
+    print(f"\npeak RSS: {report['peak_rss_mb']:.1f} MiB")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--episodes", type=int, default=50000, help="Sonarr wanted-missing episodes")
+    parser.add_argument("--movies", type=int, default=5000, help="Radarr wanted-missing movies")
+    parser.add_argument("--failures", type=int, default=500, help="failed grabs in each arr's history")
+    parser.add_argument("--noise", type=int, default=2000, help="non-failure history records per arr")
+    parser.add_argument("--sab-items", type=int, default=2, help="jobs in the SAB queue")
+    parser.add_argument("--sab-kbpersec", type=float, default=40000, help="SAB download speed")
+    parser.add_argument("--sessions", type=int, default=6, help="Plex sessions reported by Tautulli")
+    parser.add_argument("--latency", type=float, default=0, help="added latency per request in ms")
+    parser.add_argument("--cycles", type=int, default=3, help="arr-retry cycles to run")
+    parser.add_argument("--polls", type=int, default=200, help="watchdog Tautulli polls to run")
+    parser.add_argument("--unlimited-searches", action="store_true",
+                        help="bypass the search rate limiter so every search is sent")
+    parser.add_argument("--verbose", action="store_true", help="show the daemons' own log output")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    process, urls = start_fakes(args)
+    # The daemons log every action; keep that out of the report unless asked.
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            arr_retry = asyncio.run(bench_arr_retry(args, urls))
+            watchdog = asyncio.run(bench_watchdog(args, urls))
+        report = {
+            "config": vars(args),
+            "arr_retry": arr_retry,
+            "watchdog": watchdog,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+    finally:
+        process.terminate()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+SABnzbd notification script that forwards notifications to arr-retry.
+
+SAB calls notification scripts with (type, title, message). Point SAB's
+script folder at /scripts and pick this script under Notifications ->
+Notification Script; arr-retry only acts on "failed" and "error".
+"""
+import os
+import sys
+from urllib import parse, request
+
+ARR_RETRY_URL = os.environ.get("ARR_RETRY_URL", "http://arr-retry:9797")
+WEBHOOK_TOKEN = os.environ.get("ARR_RETRY_WEBHOOK_TOKEN", "")
+
+
+def main(argv):
+    kind, title, message = (argv + ["", "", ""])[:3]
+    body = parse.urlencode({"type": kind, "title": title, "message": message}).encode("utf-8")
+    url = f"{ARR_RETRY_URL}/webhook/sab"
+    if WEBHOOK_TOKEN:
+        url += "?" + parse.urlencode({"token": WEBHOOK_TOKEN})
+
+    try:
+        request.urlopen(request.Request(url, data=body), timeout=5)
+    except Exception as e:
+        # Never fail the SAB job over a notification.
+        print(f"arr-retry notification failed: {e}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
 import asyncio
+import json
+import math
 import os
+import threading
+import struct
 import time
-import docker
-import subprocess
-import aiohttp
+from urllib import parse
 
 
 TAUTULLI_URL = os.environ.get("TAUTULLI_URL", "http://tautulli:8181")
 TAUTULLI_API_KEY = os.environ.get("TAUTULLI_API_KEY", "")
 CHECK_INTERVAL = int(os.environ.get("CHECK_INTERVAL", "5"))
+# With Tautulli webhooks enabled, playback start/stop triggers a check right
+# away and polling drops to FALLBACK_CHECK_INTERVAL in case one is missed.
+TAUTULLI_WEBHOOKS = os.environ.get("TAUTULLI_WEBHOOKS", "").strip().lower() in ("1", "true", "yes")
+FALLBACK_CHECK_INTERVAL = int(os.environ.get("FALLBACK_CHECK_INTERVAL", "60"))
+WEBHOOK_TOKEN = os.environ.get("WEBHOOK_TOKEN", "").strip()
 COOLDOWN = int(os.environ.get("COOLDOWN", "30"))
-
-last_action = None
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9798"))
+UNMANIC_CONTAINER = os.environ.get("UNMANIC_CONTAINER", "unmanic")
+# "signal": SIGSTOP/SIGCONT each ffmpeg, tracked per PID (Unmanic's UI stays up).
+# "freezer": freeze the whole container through its cgroup freezer (docker
+# pause), a single API call with no exec at all.
+PAUSE_MODE = os.environ.get("PAUSE_MODE", "signal").strip().lower()
+DOCKER_SOCKET = os.environ.get("DOCKER_SOCKET", "/var/run/docker.sock")
+# Graded mode: instead of stopping Unmanic for any transcode, cap its CPU at
+# UNMANIC_CPU_STEPS[n] (fraction of HOST_CPUS) while n transcodes run, and
+# only pause it once the load goes past the last step.
+THROTTLE_MODE = os.environ.get("THROTTLE_MODE", "").strip().lower() in ("1", "true", "yes")
+UNMANIC_CPU_STEPS = [float(step) for step in os.environ.get("UNMANIC_CPU_STEPS", "1.0,0.5,0.25").split(",")]
+HOST_CPUS = int(os.environ.get("HOST_CPUS", str(os.cpu_count() or 1)))
+CPU_PERIOD = 100000
+# Transcode load is measured in cost units: one software 1080p video
+# transcode = 1.0. Loads below COST_IGNORE_BELOW (hardware or audio-only
+# transcodes) leave Unmanic alone.
+COST_IGNORE_BELOW = float(os.environ.get("COST_IGNORE_BELOW", "0.25"))
+CORES_PER_COST_UNIT = float(os.environ.get("CORES_PER_COST_UNIT", "2.0"))
+# A pause is skipped while the host would still have this many idle cores
+# after the new transcodes ramp up.
+PLEX_RESERVE_CORES = float(os.environ.get("PLEX_RESERVE_CORES", "1.0"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+
+# Control level: 0 = unrestricted, 1..len(UNMANIC_CPU_STEPS)-1 = throttled,
+# PAUSED_LEVEL = encoders stopped. None until the first check has run.
+PAUSED_LEVEL = len(UNMANIC_CPU_STEPS)
+current_level = None
 last_change_ts = 0.0
+applied_cpu_fraction = None
+
+# Set by /webhook/tautulli; wakes the main loop for an immediate check.
+ACTIVITY_CHANGED = asyncio.Event()
 
 
 def log(msg):
@@ -21,95 +58,684 @@ def log(msg):
     print(f"[{ts}] {msg}", flush=True)
 
 
-# Connect to host Docker via socket
-docker_client = docker.DockerClient(base_url="unix://var/run/docker.sock")
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_HELP = {
+    "watchdog_poll_duration_seconds": ("histogram", "Time taken by each poll, by source."),
+    "watchdog_paused_pids": ("gauge", "ffmpeg processes currently held stopped."),
+    "watchdog_transcode_load": ("gauge", "Estimated Plex transcode cost (1.0 = software 1080p)."),
+    "watchdog_host_cpu_busy": ("gauge", "Host CPU busy fraction since the previous check."),
+    "watchdog_unmanic_cpu_limit": ("gauge", "CPU fraction currently allowed to Unmanic."),
+    "watchdog_paused_seconds_total": ("counter", "Total time Unmanic has spent paused."),
+    "watchdog_actions_total": ("counter", "Pause/resume actions taken."),
+    "watchdog_active_transcodes": ("gauge", "1 while Plex is transcoding."),
+    "watchdog_events_total": ("counter", "Tautulli webhook deliveries by action."),
+    "watchdog_checks_total": ("counter", "Activity checks by trigger."),
+}
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms in Prometheus text format."""
+
+    def __init__(self, help_text):
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = [
+                (key, (list(h[0]), h[1], h[2])) for key, h in sorted(self._histograms.items())
+            ]
+
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen:
+                seen.add(name)
+                kind, text = self.help_text.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in values:
+            header(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name)
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(METRIC_HELP)
+STATUS = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "last_cycle": None}
+
+
+async def route_http(method, target, headers, body):
+    """Return (status line, content type, payload) for one request."""
+    if method == "GET" and target.path == "/metrics":
+        return "200 OK", "text/plain; version=0.0.4", METRICS.render().encode("utf-8")
+    if method == "GET" and target.path == "/status":
+        return "200 OK", "application/json", json.dumps(STATUS, indent=2).encode("utf-8")
+    if method == "POST" and target.path == "/webhook/tautulli":
+        return accept_tautulli_webhook(target, headers, body)
+    return "404 Not Found", "text/plain", b"not found\n"
+
+
+def accept_tautulli_webhook(target, headers, body):
+    """
+    Tautulli's Webhook notification agent, triggered on playback start, stop,
+    pause, resume and transcode decision change. The payload only says that
+    something changed; the check itself re-reads get_activity.
+    """
+    payload = dict(parse.parse_qsl(target.query))
+    try:
+        decoded = json.loads(body) if body else {}
+        if isinstance(decoded, dict):
+            payload.update(decoded)
+    except ValueError:
+        payload.update(parse.parse_qsl(body.decode("utf-8", "replace")))
+
+    if WEBHOOK_TOKEN and WEBHOOK_TOKEN not in (payload.get("token"), headers.get("x-webhook-token")):
+        return "401 Unauthorized", "text/plain", b"bad token\n"
 
+    METRICS.inc("watchdog_events_total", action=str(payload.get("action") or payload.get("event") or "unknown"))
+    ACTIVITY_CHANGED.set()
+    return "202 Accepted", "application/json", b'{"accepted": true}'
 
-def get_unmanic_ffmpeg_pids():
-    """Return list of ffmpeg PIDs running inside unmanic container."""
+
+async def serve_http(reader, writer):
+    """Minimal HTTP/1.1 handler: one request per connection."""
     try:
-        container = docker_client.containers.get("unmanic")
-        exec_result = container.exec_run("pgrep -f ffmpeg")
-        output = exec_result.output.decode().strip()
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        body = await asyncio.wait_for(reader.readexactly(length), 10) if length else b""
+        status, content_type, payload = await route_http(method, parse.urlsplit(target), headers, body)
+    except Exception as e:
+        status, content_type, payload = "400 Bad Request", "text/plain", f"{e}\n".encode("utf-8")
 
-        if not output:
-            return []
+    try:
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            + payload
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(serve_http, "0.0.0.0", METRICS_PORT)
+    except OSError as e:
+        log(f"[ERROR] Could not listen on port {METRICS_PORT}: {e}")
+        return None
+    log(f"Serving /metrics, /status and /webhook/tautulli on port {METRICS_PORT}")
+    return server
 
-        return [int(pid) for pid in output.split("\n") if pid.strip().isdigit()]
 
-    except Exception:
-        return []
+# -------------------------------------------------------------------
+# ASYNC HTTP (TCP and unix socket)
+# -------------------------------------------------------------------
+class HttpError(Exception):
+    def __init__(self, status, reason, body=b""):
+        super().__init__(f"HTTP {status} {reason}: {body[:200].decode('utf-8', 'replace').strip()}")
+        self.status = status
 
 
-def send_signal_to_unmanic(pid: int, signal: str):
+async def read_http_response(reader):
+    status_line = await reader.readline()
     try:
-        container = docker_client.containers.get("unmanic")
-        container.exec_run(f"kill -{signal} {pid}")
-    except Exception as e:
-        log(f"[ERROR] Failed sending {signal} to {pid}: {e}")
-
+        _, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    except ValueError:
+        raise HttpError(0, "malformed status line", status_line)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        # Hijacked streams (docker exec) end when the daemon closes them.
+        body = await reader.read()
+
+    return int(status), reason, headers, body
+
+
+async def http_request(method, url, payload=None, unix_socket=None, timeout=HTTP_TIMEOUT):
+    """
+    One HTTP/1.1 request on a fresh connection (TLS for https URLs); returns
+    (status, headers, body).
+    Non-2xx responses raise HttpError. JSON payloads are encoded for you.
+    """
+    parts = parse.urlsplit(url)
+    target = parts.path or "/"
+    if parts.query:
+        target += f"?{parts.query}"
+    body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+
+    async def exchange():
+        if unix_socket:
+            reader, writer = await asyncio.open_unix_connection(unix_socket)
+        elif parts.scheme == "https":
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 443, ssl=True)
+        else:
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        try:
+            head = (
+                f"{method} {target} HTTP/1.1\r\nHost: {parts.netloc or 'docker'}\r\n"
+                f"Accept: application/json\r\nConnection: close\r\n"
+            )
+            if payload is not None or method == "POST":
+                head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            writer.write((head + "\r\n").encode("latin-1") + body)
+            await writer.drain()
+            return await read_http_response(reader)
+        finally:
+            writer.close()
+
+    status, reason, headers, data = await asyncio.wait_for(exchange(), timeout)
+    if not 200 <= status < 300:
+        raise HttpError(status, reason, data)
+    return status, headers, data
+
+
+class DockerClient:
+    """Just enough of the Docker Engine API, spoken over its unix socket."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    async def call(self, method, path, payload=None):
+        _, headers, body = await http_request(method, f"http://docker{path}", payload, self.socket_path)
+        if body and "json" in headers.get("content-type", ""):
+            return json.loads(body)
+        return body
+
+    async def container_id(self, name):
+        return (await self.call("GET", f"/containers/{parse.quote(name)}/json"))["Id"]
+
+    async def exec(self, container_id, cmd):
+        """Run cmd in the container and return its stdout."""
+        created = await self.call("POST", f"/containers/{container_id}/exec", {
+            "Cmd": cmd,
+            "AttachStdout": True,
+            "AttachStderr": True,
+        })
+        raw = await self.call("POST", f"/exec/{created['Id']}/start", {"Detach": False, "Tty": False})
+        return demux_docker_stream(raw)
+
+    async def pause(self, container_id):
+        await self.call("POST", f"/containers/{container_id}/pause")
+
+    async def unpause(self, container_id):
+        await self.call("POST", f"/containers/{container_id}/unpause")
+
+    async def top(self, container_id):
+        return await self.call("GET", f"/containers/{container_id}/top")
+
+    async def inspect(self, container_id):
+        return await self.call("GET", f"/containers/{container_id}/json")
+
+    async def update(self, container_id, resources):
+        return await self.call("POST", f"/containers/{container_id}/update", resources)
+
+
+def demux_docker_stream(raw):
+    """Extract stdout from Docker's multiplexed stream (8-byte frame headers)."""
+    stdout = []
+    offset = 0
+    while offset + 8 <= len(raw):
+        stream, size = struct.unpack(">BxxxL", raw[offset:offset + 8])
+        frame = raw[offset + 8:offset + 8 + size]
+        if stream == 1:
+            stdout.append(frame)
+        offset += 8 + size
+    return b"".join(stdout).decode("utf-8", "replace")
+
+
+docker_client = DockerClient(DOCKER_SOCKET)
+
+# -------------------------------------------------------------------
+# PAUSE / RESUME
+# -------------------------------------------------------------------
+# Reports every ffmpeg as "pid state starttime" in one exec. "[f]fmpeg"
+# keeps pgrep from matching this shell's own command line.
+OBSERVE_SCRIPT = (
+    'for p in $(pgrep -f "[f]fmpeg"); do '
+    's=$(cut -d" " -f3,22 /proc/$p/stat 2>/dev/null) && echo "$p $s"; done'
+)
+
+_container_id = None
+
+# Encoders the watchdog has observed: pid -> {"started", "state", "since"}.
+# "started" (the kernel start time) tells a reused PID from the original.
+ENCODERS = {}
+_frozen = None
+
+
+async def with_container(action):
+    """Await action(container_id), refreshing the cached id once if it went stale."""
+    global _container_id
+    if _container_id is None:
+        _container_id = await docker_client.container_id(UNMANIC_CONTAINER)
+    try:
+        return await action(_container_id)
+    except HttpError as e:
+        if e.status != 404:
+            raise
+        # Container was recreated; its id changed.
+        _container_id = await docker_client.container_id(UNMANIC_CONTAINER)
+        return await action(_container_id)
+
+
+async def observe_encoders():
+    """Return {pid: (process state, start time)} for every ffmpeg in Unmanic."""
+    output = await with_container(
+        lambda container_id: docker_client.exec(container_id, ["sh", "-c", OBSERVE_SCRIPT])
+    )
+    observed = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0].isdigit():
+            observed[int(parts[0])] = (parts[1], parts[2])
+    return observed
+
+
+async def signal_encoders(signal, pids):
+    await with_container(
+        lambda container_id: docker_client.exec(container_id, ["kill", f"-{signal}", *map(str, pids)])
+    )
+
+
+async def set_container_frozen(frozen):
+    async def apply(container_id):
+        try:
+            if frozen:
+                await docker_client.pause(container_id)
+            else:
+                await docker_client.unpause(container_id)
+        except HttpError as e:
+            # 409: already in the requested state.
+            if e.status != 409:
+                raise
+
+    await with_container(apply)
+
+
+async def count_frozen_encoders():
+    # docker top reads /proc on the host, so it works on a frozen container.
+    top = await with_container(docker_client.top)
+    return sum(1 for process in top.get("Processes") or [] if "ffmpeg" in process[-1])
+
+
+def needs_reconcile(want_paused):
+    """Docker is only consulted while paused or while something may still be held."""
+    if want_paused:
+        return True
+    if PAUSE_MODE == "freezer":
+        return _frozen is not False
+    return any(entry["state"] == "stopped" for entry in ENCODERS.values())
+
+
+async def reconcile_freezer(want_paused):
+    global _frozen
+    inspect = await with_container(docker_client.inspect)
+    frozen = bool((inspect.get("State") or {}).get("Paused"))
+    if frozen != want_paused:
+        await set_container_frozen(want_paused)
+        count = await count_frozen_encoders()
+        log(f"[ACTION] {'Froze' if want_paused else 'Thawed'} Unmanic container ({count} ffmpeg processes)")
+        METRICS.inc("watchdog_actions_total", action="pause" if want_paused else "resume")
+        METRICS.set("watchdog_paused_pids", count if want_paused else 0)
+    _frozen = want_paused
+
+
+async def reconcile_encoders(want_paused):
+    """
+    Converge every ffmpeg in Unmanic on the desired run state: stop workers
+    that started after the pause, resume anything still stopped once running
+    is wanted, and forget encoders that have exited.
+    """
+    if PAUSE_MODE == "freezer":
+        await reconcile_freezer(want_paused)
+        return
 
-async def tautulli_get_transcodes(session):
-    """Returns True if Plex has active transcodes."""
+    observed = await observe_encoders()
+    now = time.time()
+
+    gone = [pid for pid, entry in ENCODERS.items() if observed.get(pid, (None, None))[1] != entry["started"]]
+    for pid in gone:
+        del ENCODERS[pid]
+
+    to_stop = [pid for pid, (state, _) in observed.items() if want_paused and state != "T"]
+    to_resume = [pid for pid, (state, _) in observed.items() if not want_paused and state == "T"]
+    if to_stop:
+        await signal_encoders("STOP", to_stop)
+        log(f"[ACTION] Stopped ffmpeg {to_stop}")
+        METRICS.inc("watchdog_actions_total", len(to_stop), action="pause")
+    if to_resume:
+        await signal_encoders("CONT", to_resume)
+        log(f"[ACTION] Resumed ffmpeg {to_resume}")
+        METRICS.inc("watchdog_actions_total", len(to_resume), action="resume")
+
+    wanted = "stopped" if want_paused else "running"
+    for pid, (_, started) in observed.items():
+        entry = ENCODERS.get(pid)
+        if entry is None or entry["state"] != wanted:
+            ENCODERS[pid] = {"started": started, "state": wanted, "since": now}
+
+    METRICS.set("watchdog_paused_pids", len(observed) if want_paused else 0)
+
+
+async def set_unmanic_cpu(fraction):
+    """Cap Unmanic at `fraction` of the host's CPUs (1.0 removes the cap)."""
+    if fraction >= 1:
+        resources = {"CpuPeriod": CPU_PERIOD, "CpuQuota": -1, "CpuShares": 1024}
+    else:
+        resources = {
+            "CpuPeriod": CPU_PERIOD,
+            "CpuQuota": max(1000, int(CPU_PERIOD * HOST_CPUS * fraction)),
+            # Lower weight too, so Plex wins any contention below the cap.
+            "CpuShares": max(2, int(1024 * fraction)),
+        }
+    await with_container(lambda container_id: docker_client.update(container_id, resources))
+
+
+def desired_level(load):
+    if load < COST_IGNORE_BELOW:
+        return 0
+    if not THROTTLE_MODE:
+        return PAUSED_LEVEL
+    return min(PAUSED_LEVEL, math.ceil(load))
+
+
+def would_starve_plex(load, previous_load, cpu_busy):
+    """
+    Project host headroom once the load added since the last check has
+    ramped up (what is already running shows in cpu_busy). Unknown CPU
+    usage counts as starving.
+    """
+    if cpu_busy is None:
+        return True
+    idle_cores = HOST_CPUS * (1 - cpu_busy)
+    ramping_cores = max(0.0, load - previous_load) * CORES_PER_COST_UNIT
+    return idle_cores - ramping_cores < PLEX_RESERVE_CORES
+
+
+async def apply_cpu_level(level):
+    """Set Unmanic's CPU cap for a throttle level; a pause keeps the last cap."""
+    global applied_cpu_fraction
+    if not THROTTLE_MODE or level == PAUSED_LEVEL:
+        return
+    fraction = UNMANIC_CPU_STEPS[level]
+    if fraction == applied_cpu_fraction:
+        return
+    await set_unmanic_cpu(fraction)
+    applied_cpu_fraction = fraction
+    log(f"[ACTION] Unmanic CPU limit set to {fraction:.0%} of {HOST_CPUS} CPUs")
+    METRICS.inc("watchdog_actions_total", action="throttle")
+    METRICS.set("watchdog_unmanic_cpu_limit", fraction)
+
+# -------------------------------------------------------------------
+# TAUTULLI
+# -------------------------------------------------------------------
+# Relative pixel throughput per resolution label, 1080p = 1.0.
+RESOLUTION_WEIGHTS = {
+    "4k": 4.0, "2160": 4.0, "1440": 1.8, "1080": 1.0,
+    "720": 0.45, "576": 0.3, "480": 0.25, "sd": 0.25,
+}
+# Share of a software transcode spent decoding vs encoding, and what is left
+# of either when the GPU does it.
+DECODE_SHARE = 0.3
+ENCODE_SHARE = 0.7
+HW_COST_FACTOR = 0.1
+AUDIO_TRANSCODE_COST = 0.05
+
+
+def resolution_weight(value):
+    return RESOLUTION_WEIGHTS.get(str(value or "").lower().rstrip("p"), 1.0)
+
+
+def session_cost(session):
+    """Estimated CPU cost of one Plex session in cost units."""
+    video = (session.get("stream_video_decision") or session.get("video_decision") or "").lower()
+    audio = (session.get("stream_audio_decision") or session.get("audio_decision") or "").lower()
+    audio_cost = AUDIO_TRANSCODE_COST if audio == "transcode" else 0.0
+
+    if video == "transcode":
+        hw_decode = str(session.get("transcode_hw_decoding") or "0") not in ("0", "false")
+        hw_encode = str(session.get("transcode_hw_encoding") or "0") not in ("0", "false")
+        decode = DECODE_SHARE * resolution_weight(session.get("video_resolution"))
+        encode = ENCODE_SHARE * resolution_weight(
+            session.get("stream_video_resolution") or session.get("video_resolution")
+        )
+        return (
+            decode * (HW_COST_FACTOR if hw_decode else 1.0)
+            + encode * (HW_COST_FACTOR if hw_encode else 1.0)
+            + audio_cost
+        )
+
+    if not video and not audio:
+        # No per-stream detail; fall back to the overall decision.
+        decision = (session.get("transcode_decision") or "").lower()
+        return 1.0 if decision == "transcode" else 0.0
+
+    return audio_cost
+
+
+_cpu_sample = None
+
+
+def sample_host_cpu():
+    """Host CPU busy fraction since the previous call (None on the first)."""
+    global _cpu_sample
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+
+    # user nice system idle iowait irq softirq steal; guest time is already
+    # counted in user/nice.
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    previous, _cpu_sample = _cpu_sample, (idle, total)
+    if previous is None or total <= previous[1]:
+        return None
+    return 1 - (idle - previous[0]) / (total - previous[1])
+
+
+async def tautulli_transcode_load():
+    """Returns the summed cost of active Plex sessions."""
     params = {
         "apikey": TAUTULLI_API_KEY,
         "cmd": "get_activity",
     }
 
     try:
-        async with session.get(f"{TAUTULLI_URL}/api/v2", params=params) as resp:
-            data = await resp.json()
+        _, _, body = await http_request("GET", f"{TAUTULLI_URL}/api/v2?{parse.urlencode(params)}")
+        data = json.loads(body)
     except Exception:
-        return False
+        return 0.0
 
     sessions = data.get("response", {}).get("data", {}).get("sessions", []) or []
 
-    for s in sessions:
-        decision = s.get("transcode_decision") or s.get("stream_video_decision")
-        if decision and decision.lower() != "copy":
-            return True
-
-    return False
+    return round(sum(session_cost(s) for s in sessions), 3)
 
 
 async def main():
-    global last_action, last_change_ts
+    global current_level, last_change_ts
 
-    log("Watchdog started (Docker-socket mode).")
+    mode = f"throttle mode, steps {UNMANIC_CPU_STEPS}" if THROTTLE_MODE else "pause mode"
+    log(f"Watchdog started (Docker-socket mode, {mode}, pause via {PAUSE_MODE}).")
 
     if not TAUTULLI_API_KEY:
         log("[ERROR] TAUTULLI_API_KEY missing")
         return
 
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                transcodes = await tautulli_get_transcodes(session)
-                pids = get_unmanic_ffmpeg_pids()
-                now = time.time()
-
-                if transcodes:
-                    if pids and last_action != "paused" and now - last_change_ts >= COOLDOWN:
-                        log(f"[ACTION] Pausing {len(pids)} ffmpeg processes")
-                        for pid in pids:
-                            send_signal_to_unmanic(pid, "STOP")
-
-                        last_action = "paused"
-                        last_change_ts = now
-
-                else:
-                    if pids and last_action != "resumed" and now - last_change_ts >= COOLDOWN:
-                        log(f"[ACTION] Resuming {len(pids)} ffmpeg processes")
-                        for pid in pids:
-                            send_signal_to_unmanic(pid, "CONT")
-
-                        last_action = "resumed"
-                        last_change_ts = now
-
-            except Exception as e:
-                log(f"[ERROR] Loop error: {e}")
-
-            await asyncio.sleep(CHECK_INTERVAL)
+    await start_http_server()
+    last_tick = time.monotonic()
+    poll_interval = CHECK_INTERVAL
+    if TAUTULLI_WEBHOOKS:
+        poll_interval = FALLBACK_CHECK_INTERVAL
+        log(f"Tautulli webhooks enabled; fallback poll every {FALLBACK_CHECK_INTERVAL}s")
+    trigger = "startup"
+    synced = False
+    level = 0
+    load = 0.0
+    sample_host_cpu()
+
+    while True:
+        phases = {}
+        # Cleared before the poll so an event arriving mid-check still
+        # triggers another one.
+        ACTIVITY_CHANGED.clear()
+        METRICS.inc("watchdog_checks_total", trigger=trigger)
+        try:
+            started = time.monotonic()
+            previous_load, load = load, await tautulli_transcode_load()
+            phases["tautulli"] = round(time.monotonic() - started, 3)
+            cpu_busy = sample_host_cpu()
+
+            METRICS.observe("watchdog_poll_duration_seconds", phases["tautulli"], source="tautulli")
+            METRICS.set("watchdog_active_transcodes", 1 if load >= COST_IGNORE_BELOW else 0)
+            METRICS.set("watchdog_transcode_load", load)
+            if cpu_busy is not None:
+                METRICS.set("watchdog_host_cpu_busy", round(cpu_busy, 3))
+            level = desired_level(load)
+            now = time.time()
+
+            # Only enter a pause when the host really lacks room for Plex;
+            # once paused, the cost model alone decides when to let go.
+            if (
+                level == PAUSED_LEVEL
+                and current_level != PAUSED_LEVEL
+                and not would_starve_plex(load, previous_load, cpu_busy)
+            ):
+                level = PAUSED_LEVEL - 1 if THROTTLE_MODE else (current_level or 0)
+
+            # Restricting Unmanic never waits; relaxing waits out COOLDOWN so
+            # a stream that stops and restarts does not flap the encoders.
+            tightening = current_level is None or level > current_level
+            if level != current_level and (tightening or now - last_change_ts >= COOLDOWN):
+                if current_level is not None:
+                    log(f"[STATE] Level {current_level} -> {level} (load {load})")
+                # Cap first so resumed encoders do not burst past the new limit.
+                await apply_cpu_level(level)
+                current_level = level
+                last_change_ts = now
+
+            # Converge the encoders on the desired state every check, so
+            # workers started mid-pause are stopped too. At startup this also
+            # releases anything a previous run left stopped.
+            want_paused = current_level == PAUSED_LEVEL
+            if not synced or needs_reconcile(want_paused):
+                started = time.monotonic()
+                await reconcile_encoders(want_paused)
+                synced = True
+                phases["docker"] = round(time.monotonic() - started, 3)
+                METRICS.observe("watchdog_poll_duration_seconds", phases["docker"], source="docker")
+
+        except Exception as e:
+            log(f"[ERROR] Loop error: {e}")
+
+        tick = time.monotonic()
+        if current_level == PAUSED_LEVEL:
+            METRICS.inc("watchdog_paused_seconds_total", round(tick - last_tick, 3))
+        last_tick = tick
+
+        STATUS["last_cycle"] = {
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "trigger": trigger,
+            "level": current_level,
+            "load": load,
+            "paused": current_level == PAUSED_LEVEL,
+            "encoders": {str(pid): entry["state"] for pid, entry in ENCODERS.items()},
+            "phases": phases,
+        }
+
+        wait = poll_interval
+        cooldown_left = COOLDOWN - (time.time() - last_change_ts)
+        if cooldown_left > 0 and current_level is not None and level < current_level:
+            # A relaxation is being held back by COOLDOWN; check again as it ends.
+            wait = min(wait, cooldown_left)
+        if current_level == PAUSED_LEVEL:
+            # Keep checking for encoders that start while paused.
+            wait = min(wait, CHECK_INTERVAL)
+
+        try:
+            await asyncio.wait_for(ACTIVITY_CHANGED.wait(), wait)
+            trigger = "event"
+        except asyncio.TimeoutError:
+            trigger = "poll"
 
 
 if __name__ == "__main__":